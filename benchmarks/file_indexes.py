@@ -0,0 +1,83 @@
+"""
+Times the hot `files` queries on a pre-index database, then migrates it in place and times them again.
+
+Usage:
+    python -m benchmarks.file_indexes --rows 200000 --vaults 20
+"""
+import os
+import time
+import random
+import argparse
+import tempfile
+import statistics
+
+from sqlalchemy import create_engine, text
+
+from obsync.db.migrations import migrate
+from tests.legacy import populate
+
+
+QUERIES = {
+    "get_vault_files": (
+        "SELECT uid, path, hash FROM files "
+        "WHERE vault_id = :vault AND deleted = 0 AND newest = 1"
+    ),
+    "insert_metadata (newest lookup)": (
+        "SELECT uid FROM files WHERE vault_id = :vault AND path = :path AND newest = 1"
+    ),
+    "get_file_history": (
+        "SELECT uid, modified FROM files WHERE vault_id = :vault AND path = :path "
+        "ORDER BY modified DESC, uid DESC LIMIT 101"
+    ),
+}
+
+
+def measure(engine, params: list, repeat: int) -> dict:
+    results = {}
+    with engine.connect() as conn:
+        for name, sql in QUERIES.items():
+            timings = []
+            for _ in range(repeat):
+                p = random.choice(params)
+                start = time.perf_counter()
+                conn.execute(text(sql), p).fetchall()
+                timings.append((time.perf_counter() - start) * 1000)
+            results[name] = statistics.median(timings)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--vaults", type=int, default=20)
+    parser.add_argument("--revisions", type=int, default=10, help="revisions per note")
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        with engine.begin() as conn:
+            populate(conn, args.rows, args.vaults, args.revisions)
+
+        notes = args.rows // args.revisions
+        params = [
+            {"vault": f"vault-{n % args.vaults}", "path": f"notes/{n}.md"}
+            for n in random.sample(range(notes), min(notes, 1000))
+        ]
+
+        before = measure(engine, params, args.repeat)
+        start = time.perf_counter()
+        migrate(engine)
+        migrated = time.perf_counter() - start
+        after = measure(engine, params, args.repeat)
+        engine.dispose()
+
+    print(f"{args.rows} revisions, {args.vaults} vaults, migration took {migrated:.2f}s")
+    print(f"{'query':<34}{'before ms':>12}{'after ms':>12}{'speedup':>10}")
+    for name in QUERIES:
+        speedup = before[name] / after[name] if after[name] else float("inf")
+        print(f"{name:<34}{before[name]:>12.3f}{after[name]:>12.3f}{speedup:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,413 @@
+"""
+Drives simulated Obsidian devices against the sync websocket and reports latency, throughput and server memory.
+
+Each device connects to one of the vaults, runs `init`, then sends a weighted mix of
+`push` (with pieces), `pull`, `size`, `history` and `ping` for the given duration.
+Broadcasts from other devices on the same vault are received and counted as they would be by a real client.
+
+By default a server is started on a free local port in a temporary data directory, either as a
+subprocess (so its RSS can be measured on its own) or with --in-process. Use --url to target a
+server that is already running.
+
+Usage:
+    python -m benchmarks.sync_load --devices 200 --vaults 20 --duration 30
+    python -m benchmarks.sync_load --sizes lognormal:7.5,1.5 --max-size 8388608
+    python -m benchmarks.sync_load --url ws://localhost:6666 --json results.json
+"""
+import os
+import sys
+import json
+import math
+import time
+import uuid
+import random
+import socket
+import asyncio
+import argparse
+import tempfile
+import threading
+import statistics
+import subprocess
+from collections import defaultdict
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import httpx
+import websockets
+
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+WS_PATH = "/ws.obsidian.md"
+OPS = ("push", "pull", "size", "history", "ping")
+DEFAULT_MIX = "push=40,pull=30,size=10,history=10,ping=10"
+
+
+def parse_sizes(spec: str, max_size: int) -> Callable[[], int]:
+    """
+    Builds a file size sampler from `fixed:N`, `uniform:LO-HI` or `lognormal:MU,SIGMA`
+    (sizes in bytes, lognormal parameters of the natural log of the size).
+    """
+    kind, _, args = spec.partition(":")
+    if kind == "fixed":
+        size = int(args)
+        sample = lambda: size
+    elif kind == "uniform":
+        lo, hi = (int(v) for v in args.split("-"))
+        sample = lambda: random.randint(lo, hi)
+    elif kind == "lognormal":
+        mu, sigma = (float(v) for v in args.split(","))
+        sample = lambda: int(random.lognormvariate(mu, sigma))
+    else:
+        raise argparse.ArgumentTypeError(f"Unknown size distribution {spec!r}")
+    return lambda: max(1, min(sample(), max_size))
+
+
+def parse_mix(spec: str) -> Dict[str, int]:
+    mix = {}
+    for part in spec.split(","):
+        op, _, weight = part.partition("=")
+        if op not in OPS:
+            raise argparse.ArgumentTypeError(f"Unknown op {op!r}, expected one of {', '.join(OPS)}")
+        mix[op] = int(weight)
+    return mix
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def rss_bytes(pid: int) -> Optional[int]:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+class Stats:
+    def __init__(self):
+        self.latency: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.bytes_up = 0
+        self.bytes_down = 0
+        self.broadcasts = 0
+
+    def record(self, op: str, seconds: float) -> None:
+        self.latency[op].append(seconds * 1000)
+
+
+class Device:
+    """One simulated client: a websocket on a vault, following the stock client's request/reply order."""
+
+    def __init__(self, url: str, token: str, vault_id: str, name: str, args, stats: Stats):
+        self.url = url
+        self.token = token
+        self.vault_id = vault_id
+        self.name = name
+        self.args = args
+        self.stats = stats
+        self.uids: List[int] = []
+        self.paths: List[str] = []
+        self.ws = None
+
+    async def _recv(self):
+        """Next reply, skipping broadcasts of other devices' pushes."""
+        while True:
+            frame = await self.ws.recv()
+            if isinstance(frame, bytes):
+                return frame
+            msg = json.loads(frame)
+            if msg.get("op") == "push":
+                self.stats.broadcasts += 1
+                if msg.get("uid") and not msg.get("deleted"):
+                    self.uids.append(msg["uid"])
+                continue
+            return msg
+
+    async def connect(self) -> None:
+        start = time.perf_counter()
+        self.ws = await websockets.connect(self.url + WS_PATH, max_size=None)
+        await self.ws.send(json.dumps({
+            "op": "init",
+            "token": self.token,
+            "id": self.vault_id,
+            "keyhash": "bench",
+            "version": 0,
+            "initial": True,
+            "device": self.name,
+        }))
+        reply = await self._recv()
+        if reply != {"res": "ok"}:
+            raise RuntimeError(f"init refused: {reply}")
+        while (await self._recv()).get("op") != "ready":
+            pass
+        self.stats.record("init", time.perf_counter() - start)
+
+    async def push(self) -> None:
+        size = self.args.size()
+        data = os.urandom(size)
+        pieces = math.ceil(size / self.args.piece_size)
+        path = f"{self.name}/{len(self.paths) % self.args.files}.md"
+        await self.ws.send(json.dumps({
+            "op": "push",
+            "path": path,
+            "extension": "md",
+            "hash": uuid.uuid4().hex,
+            "ctime": 0,
+            "mtime": 0,
+            "folder": False,
+            "deleted": False,
+            "size": size,
+            "pieces": pieces,
+        }))
+        for i in range(pieces):
+            reply = await self._recv()
+            if reply != {"res": "next"}:
+                raise RuntimeError(f"push refused: {reply}")
+            await self.ws.send(data[i * self.args.piece_size : (i + 1) * self.args.piece_size])
+        reply = await self._recv()
+        if reply != {"op": "ok"}:
+            raise RuntimeError(f"push failed: {reply}")
+        self.paths.append(path)
+        self.stats.bytes_up += size
+
+    async def pull(self) -> None:
+        if not self.uids:
+            return await self.push()
+        await self.ws.send(json.dumps({"op": "pull", "uid": random.choice(self.uids)}))
+        header = await self._recv()
+        for _ in range(header["pieces"]):
+            self.stats.bytes_down += len(await self._recv())
+
+    async def size(self) -> None:
+        await self.ws.send(json.dumps({"op": "size"}))
+        await self._recv()
+
+    async def history(self) -> None:
+        if not self.paths:
+            return await self.push()
+        await self.ws.send(json.dumps({"op": "history", "path": random.choice(self.paths), "last": None}))
+        await self._recv()
+
+    async def ping(self) -> None:
+        await self.ws.send(json.dumps({"op": "ping"}))
+        await self._recv()
+
+    async def run(self, deadline: float, mix: Dict[str, int]) -> None:
+        ops, weights = list(mix), list(mix.values())
+        try:
+            await self.connect()
+            while time.perf_counter() < deadline:
+                op = random.choices(ops, weights)[0]
+                start = time.perf_counter()
+                try:
+                    await getattr(self, op)()
+                except (RuntimeError, KeyError) as e:
+                    self.stats.errors[op] += 1
+                    if self.args.verbose:
+                        print(f"{self.name} {op}: {e}", file=sys.stderr)
+                    continue
+                self.stats.record(op, time.perf_counter() - start)
+                if self.args.think_ms:
+                    await asyncio.sleep(random.expovariate(1000 / self.args.think_ms))
+        except (OSError, websockets.ConnectionClosed) as e:
+            self.stats.errors["connection"] += 1
+            if self.args.verbose:
+                print(f"{self.name}: {e}", file=sys.stderr)
+        finally:
+            if self.ws is not None:
+                await self.ws.close()
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_for_port(port: int, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Server did not start listening on port {port}")
+
+
+def start_subprocess(data_dir: str, port: int) -> subprocess.Popen:
+    # DATA_DIR is "." by default, so the server keeps its database and blobs in its working directory
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [str(REPO_ROOT), os.environ.get("PYTHONPATH")]))}
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "obsync.main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=data_dir,
+        env=env,
+        stdout=subprocess.DEVNULL,
+    )
+    _wait_for_port(port)
+    return process
+
+
+def start_in_process(data_dir: str, port: int):
+    import uvicorn
+
+    os.chdir(data_dir)  # NOTE: before obsync is imported, which opens the database in DATA_DIR
+    from obsync.main import app
+
+    server = uvicorn.Server(uvicorn.Config(app, port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    _wait_for_port(port)
+    return server
+
+
+def setup(http_url: str, vaults: int, signup_key: str) -> tuple:
+    email = f"bench-{uuid.uuid4().hex[:8]}@example.com"
+    with httpx.Client(base_url=http_url, timeout=30) as http:
+        http.post("/user/signup", json={"email": email, "password": "bench", "name": "bench", "signup_key": signup_key})
+        token = http.post("/user/signin", json={"email": email, "password": "bench"}).json()["token"]
+        ids = []
+        for i in range(vaults):
+            response = http.post(
+                "/vault/create",
+                json={"token": token, "name": f"bench-{i}", "salt": "salt", "keyhash": "bench"},
+            )
+            ids.append(response.json()["id"])
+    return token, ids
+
+
+async def sample_rss(pid: Optional[int], samples: List[int], stop: asyncio.Event) -> None:
+    while pid is not None and not stop.is_set():
+        rss = rss_bytes(pid)
+        if rss is not None:
+            samples.append(rss)
+        try:
+            await asyncio.wait_for(stop.wait(), 0.5)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def drive(url: str, token: str, vault_ids: List[str], pid: Optional[int], args) -> tuple:
+    stats = Stats()
+    devices = [
+        Device(url, token, vault_ids[i % len(vault_ids)], f"device-{i}", args, stats)
+        for i in range(args.devices)
+    ]
+    rss: List[int] = []
+    stop = asyncio.Event()
+    sampler = asyncio.create_task(sample_rss(pid, rss, stop))
+
+    start = time.perf_counter()
+    deadline = start + args.duration
+    # Stagger connects over the ramp-up so they do not all land in the same instant
+    async def staggered(device: Device, delay: float):
+        await asyncio.sleep(delay)
+        await device.run(deadline, args.mix)
+
+    await asyncio.gather(*(
+        staggered(device, args.ramp * i / len(devices)) for i, device in enumerate(devices)
+    ))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await sampler
+    return stats, elapsed, rss
+
+
+def report(stats: Stats, elapsed: float, rss: List[int], args) -> dict:
+    total = sum(len(v) for op, v in stats.latency.items() if op != "init")
+    result = {
+        "devices": args.devices,
+        "vaults": args.vaults,
+        "duration_s": round(elapsed, 2),
+        "ops_per_s": round(total / elapsed, 1),
+        "upload_mb_per_s": round(stats.bytes_up / elapsed / 1048576, 2),
+        "download_mb_per_s": round(stats.bytes_down / elapsed / 1048576, 2),
+        "broadcasts_received": stats.broadcasts,
+        "errors": dict(stats.errors),
+        "rss_peak_mb": round(max(rss) / 1048576, 1) if rss else None,
+        "rss_final_mb": round(rss[-1] / 1048576, 1) if rss else None,
+        "ops": {
+            op: {
+                "count": len(values),
+                "p50_ms": round(percentile(values, 50), 2),
+                "p99_ms": round(percentile(values, 99), 2),
+                "mean_ms": round(statistics.fmean(values), 2),
+            }
+            for op, values in sorted(stats.latency.items())
+        },
+    }
+
+    print(
+        f"{args.devices} devices on {args.vaults} vaults for {elapsed:.1f}s: "
+        f"{result['ops_per_s']} ops/s, up {result['upload_mb_per_s']} MB/s, "
+        f"down {result['download_mb_per_s']} MB/s, {stats.broadcasts} broadcasts received"
+    )
+    if rss:
+        print(f"server RSS peak {result['rss_peak_mb']} MB, final {result['rss_final_mb']} MB")
+    print(f"{'op':<10}{'count':>10}{'p50 ms':>12}{'p99 ms':>12}{'mean ms':>12}")
+    for op, row in result["ops"].items():
+        print(f"{op:<10}{row['count']:>10}{row['p50_ms']:>12.2f}{row['p99_ms']:>12.2f}{row['mean_ms']:>12.2f}")
+    if stats.errors:
+        print("errors: " + ", ".join(f"{op}={n}" for op, n in sorted(stats.errors.items())))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--devices", type=int, default=50)
+    parser.add_argument("--vaults", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=20, help="seconds of load after connecting")
+    parser.add_argument("--ramp", type=float, default=2, help="seconds over which devices connect")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f"op weights, default {DEFAULT_MIX}")
+    parser.add_argument("--sizes", default="lognormal:7.5,1.5", help="fixed:N, uniform:LO-HI or lognormal:MU,SIGMA (bytes)")
+    parser.add_argument("--max-size", type=int, default=8 * 1048576)
+    parser.add_argument("--piece-kb", type=int, default=2048, help="piece size the devices upload with")
+    parser.add_argument("--files", type=int, default=20, help="distinct paths per device; pushes cycle through them")
+    parser.add_argument("--think-ms", type=float, default=0, help="mean pause between a device's requests")
+    parser.add_argument("--url", help="ws://host:port of a running server instead of starting one")
+    parser.add_argument("--in-process", action="store_true", help="serve from this process instead of a subprocess")
+    parser.add_argument("--signup-key", default="")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    args.size = parse_sizes(args.sizes, args.max_size)
+    args.piece_size = args.piece_kb * 1024
+
+    with tempfile.TemporaryDirectory() as tmp:
+        process = server = None
+        pid = None
+        if args.url:
+            url = args.url.rstrip("/")
+        else:
+            port = _free_port()
+            url = f"ws://127.0.0.1:{port}"
+            if args.in_process:
+                server = start_in_process(tmp, port)
+                pid = os.getpid()
+            else:
+                process = start_subprocess(tmp, port)
+                pid = process.pid
+        try:
+            token, vault_ids = setup(url.replace("ws", "http", 1), args.vaults, args.signup_key)
+            stats, elapsed, rss = asyncio.run(drive(url, token, vault_ids, pid, args))
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait()
+            if server is not None:
+                server.should_exit = True
+
+    result = report(stats, elapsed, rss, args)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
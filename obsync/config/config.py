@@ -1,6 +1,7 @@
 import os
 import random
 import pickle
+import importlib.util
 from pathlib import Path
 import yaml
 
@@ -13,23 +14,108 @@ DataDir = "."
 SignUpKey = ""
 MaxStorageBytes = 10 * 1073741824  # 10 GB
 MaxSitesPerUser = 5
+PieceSize = 2 * 1048576  # 2 MB
+HistoryPageSize = 100
+
+# Database engine tuning, see the DATABASE section of config.yml
+DBJournalMode = "WAL"
+DBSynchronous = "NORMAL"
+DBReaders = 4
+DBBusyTimeoutMs = 5000
+DBMmapBytes = 256 * 1048576  # 256 MB
+DBCacheBytes = 64 * 1048576  # 64 MB
+
+# How websocket broadcasts reach clients, see the BROADCAST section of config.yml
+BroadcastBackend = "local"
+BroadcastPollMs = 50
+BroadcastRetentionS = 60
+
+# Background pruning of file history, see the COMPACTION section of config.yml
+CompactionIntervalS = 600
+CompactionBatchSize = 500
+KeepRevisions = 10
+KeepDays = 30
+
+# How blob content is laid out on disk, see the STORAGE section of config.yml
+DeltaKeyframeInterval = 16
+Compression = "zstd"
+RecompressBatchSize = 100
+
+# How published sites are served, see the PUBLISH section of config.yml
+PublishCacheControl = "public, no-cache"
+PublishCacheBytes = 64 * 1048576  # 64 MB
+PublishMaxBytes = 50 * 1048576  # 50 MB
+PublishIndexPageSize = 1000
 
 SecretPath = os.path.join(DataDir, "secret.gob")
 
 
 def init():
-    global SecretPath, Host, DataDir, Secret, SignUpKey, MaxStorageBytes, MaxSitesPerUser
+    global SecretPath, Host, DataDir, Secret, SignUpKey, MaxStorageBytes, MaxSitesPerUser, PieceSize
+    global HistoryPageSize
+    global DBJournalMode, DBSynchronous, DBReaders, DBBusyTimeoutMs, DBMmapBytes, DBCacheBytes
+    global BroadcastBackend, BroadcastPollMs, BroadcastRetentionS
+    global CompactionIntervalS, CompactionBatchSize, KeepRevisions, KeepDays
+    global DeltaKeyframeInterval, Compression, RecompressBatchSize
+    global PublishCacheControl, PublishCacheBytes, PublishMaxBytes, PublishIndexPageSize
 
     config_file_path = os.path.join(Path(__file__).parent.parent, "config.yml")
     with open(config_file_path, "r") as file:
         config = yaml.safe_load(file)
 
-    Host, SignUpKey, DataDir, MaxStorageBytes, MaxSitesPerUser = (
+    Host, SignUpKey, DataDir, MaxStorageBytes, MaxSitesPerUser, PieceSize = (
         config.get("HOST", "localhost:3000"),
         config.get("SIGNUP_KEY", ""),
         config.get("DATA_DIR", "."),
         int(config.get("MAX_STORAGE_GB", 10)) * 1073741824,
         int(config.get("MAX_SITES_PER_USER", 5)),
+        int(config.get("PIECE_SIZE_KB", 2048)) * 1024,
+    )
+    HistoryPageSize = max(1, int(config.get("HISTORY_PAGE_SIZE", 100)))
+
+    database = config.get("DATABASE") or {}
+    DBJournalMode, DBSynchronous, DBReaders, DBBusyTimeoutMs, DBMmapBytes, DBCacheBytes = (
+        str(database.get("JOURNAL_MODE", "WAL")).upper(),
+        str(database.get("SYNCHRONOUS", "NORMAL")).upper(),
+        max(1, int(database.get("READERS", 4))),
+        int(database.get("BUSY_TIMEOUT_MS", 5000)),
+        int(database.get("MMAP_SIZE_MB", 256)) * 1048576,
+        int(database.get("CACHE_SIZE_MB", 64)) * 1048576,
+    )
+
+    broadcast = config.get("BROADCAST") or {}
+    BroadcastBackend, BroadcastPollMs, BroadcastRetentionS = (
+        str(broadcast.get("BACKEND", "local")).lower(),
+        int(broadcast.get("POLL_INTERVAL_MS", 50)),
+        int(broadcast.get("RETENTION_S", 60)),
+    )
+
+    compaction = config.get("COMPACTION") or {}
+    CompactionIntervalS, CompactionBatchSize, KeepRevisions, KeepDays = (
+        int(compaction.get("INTERVAL_S", 600)),
+        int(compaction.get("BATCH_SIZE", 500)),
+        int(compaction.get("KEEP_REVISIONS", 10)),
+        int(compaction.get("KEEP_DAYS", 30)),
+    )
+
+    storage = config.get("STORAGE") or {}
+    DeltaKeyframeInterval, Compression, RecompressBatchSize = (
+        max(1, int(storage.get("DELTA_KEYFRAME_INTERVAL", 16))),
+        str(storage.get("COMPRESSION", "zstd")).lower(),
+        int(storage.get("RECOMPRESS_BATCH_SIZE", 100)),
+    )
+    if Compression == "zstd" and importlib.util.find_spec("zstandard") is None:
+        from obsync.logger import logger
+
+        logger.warning("zstandard is not installed, compressing with zlib instead")
+        Compression = "zlib"
+
+    publish = config.get("PUBLISH") or {}
+    PublishCacheControl, PublishCacheBytes, PublishMaxBytes, PublishIndexPageSize = (
+        str(publish.get("CACHE_CONTROL", "public, no-cache")),
+        int(publish.get("CACHE_SIZE_MB", 64)) * 1048576,
+        int(publish.get("MAX_FILE_MB", 50)) * 1048576,
+        max(1, int(publish.get("INDEX_PAGE_SIZE", 1000))),
     )
 
     Path(DataDir).mkdir(parents=True, exist_ok=True)
@@ -1 +1 @@
-from .db import session_handler, Base
+from .db import session_handler, Base, CHUNK_SIZE
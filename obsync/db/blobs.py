@@ -0,0 +1,155 @@
+import os
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import Session, SessionTransaction
+
+from obsync.config import config
+from obsync.db import session_handler, CHUNK_SIZE
+from obsync.storage import blobstore, codecs
+from obsync.storage.blobstore import StagedBlob
+
+from .models.blobs import Blob
+from .models.vaultfiles import File
+from .models.publish import PublishFile
+
+# Keys in `Session.info` of blob store changes held back until the transaction commits,
+# so a failed commit never leaves rows pointing at removed content
+PLACE = "obsync_place_blobs"
+REMOVE = "obsync_remove_blobs"
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_blob_changes(session: Session) -> None:
+    for staged in session.info.pop(PLACE, []):
+        blobstore.place(staged)
+    for key in session.info.pop(REMOVE, []):
+        blobstore.remove(key)
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _drop_blob_changes(session: Session, transaction: SessionTransaction) -> None:
+    if transaction.parent is not None:
+        return
+    # Anything still held back belongs to a transaction that did not commit
+    session.info.pop(REMOVE, None)
+    for staged in session.info.pop(PLACE, []):
+        blobstore.discard(staged)
+
+
+def attach(session: Session, staged: StagedBlob) -> str:
+    """
+    Takes a reference on the staged content and moves it into the blob store.
+    Content staged as a delta is kept as one while its chain is short and the delta pays off,
+    otherwise it is written out in full as a new keyframe.
+    Must run inside the caller's write transaction; the content is placed once the caller commits.
+    """
+    if session.query(Blob.hash).filter(Blob.hash == staged.hash).first() is not None:
+        session.query(Blob).filter(Blob.hash == staged.hash).update(
+            {Blob.refcount: Blob.refcount + 1}
+        )
+    else:
+        base, depth = None, 0
+        if staged.base is not None:
+            parent = session.query(Blob.depth).filter(Blob.hash == staged.base).first()
+            patch_size = os.path.getsize(staged.path) - blobstore.KEY_LENGTH
+            if (
+                parent is not None
+                and parent.depth + 1 < config.DeltaKeyframeInterval
+                and patch_size * 2 <= staged.size
+            ):
+                base, depth = staged.base, parent.depth + 1
+                session.query(Blob).filter(Blob.hash == base).update(
+                    {Blob.refcount: Blob.refcount + 1}
+                )
+            else:
+                staged = blobstore.materialize(staged)
+        session.add(
+            Blob(
+                hash=staged.hash,
+                size=staged.size,
+                refcount=1,
+                base=base,
+                depth=depth,
+                codec=staged.codec,
+            )
+        )
+        session.flush()
+    session.info.setdefault(PLACE, []).append(staged)
+    return staged.hash
+
+
+def release(session: Session, keys: Iterable[Optional[str]]) -> None:
+    """
+    Drops one reference per key and removes blobs that are no longer referenced,
+    along with the references they held on their delta bases.
+    Must run inside the caller's write transaction; the files go once the caller commits.
+    """
+    counts = Counter(key for key in keys if key)
+    for key, n in counts.items():
+        session.query(Blob).filter(Blob.hash == key).update(
+            {Blob.refcount: Blob.refcount - n}
+        )
+
+    keys = list(counts)
+    bases = []
+    for i in range(0, len(keys), CHUNK_SIZE):
+        chunk = keys[i : i + CHUNK_SIZE]
+        orphans = session.query(Blob.hash, Blob.base).filter(
+            Blob.hash.in_(chunk), Blob.refcount <= 0
+        ).all()
+        if not orphans:
+            continue
+        session.query(Blob).filter(Blob.hash.in_([row.hash for row in orphans])).delete()
+        for row in orphans:
+            session.info.setdefault(REMOVE, []).append(row.hash)
+            bases.append(row.base)
+
+    if any(bases):
+        release(session, bases)
+
+
+@session_handler(readonly=True)
+def get_uncompressed_blobs(limit: int, session: Session) -> List[Tuple[str, int, Optional[str]]]:
+    """
+    Returns (hash, size, name) of up to `limit` blobs never considered for compression, where
+    name is the extension of a revision or else the path of a published page using the blob.
+    """
+    extension = (
+        select(File.extension)
+        .where(File.blob == Blob.hash, File.extension != None)
+        .limit(1)
+        .scalar_subquery()
+    )
+    page = select(PublishFile.path).where(PublishFile.blob == Blob.hash).limit(1).scalar_subquery()
+    return [
+        (row.hash, row.size, row.name)
+        for row in session.query(Blob.hash, Blob.size, func.coalesce(extension, page).label("name"))
+        .filter(Blob.codec == None)
+        .limit(limit)
+    ]
+
+
+@session_handler
+def set_codecs(results: Dict[str, Optional[StagedBlob]], session: Session) -> int:
+    """
+    Records the outcome of recompressing blobs: swaps in each compressed copy, or marks the
+    blob as stored uncompressed when there is none. Returns the number of blobs compressed.
+    """
+    compressed = 0
+    try:
+        for key, staged in results.items():
+            if session.query(Blob.hash).filter(Blob.hash == key, Blob.codec == None).first() is None:
+                continue  # NOTE: released meanwhile
+            codec = codecs.NONE if staged is None else staged.codec
+            session.query(Blob).filter(Blob.hash == key).update({Blob.codec: codec})
+            if staged is not None:
+                blobstore.swap(staged)
+                compressed += 1
+        session.commit()
+    finally:
+        for staged in results.values():
+            if staged is not None:
+                blobstore.discard(staged)
+    return compressed
@@ -1,18 +1,71 @@
 import os
-from sqlalchemy import create_engine
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker, declarative_base
 from sqlalchemy.exc import SQLAlchemyError
 
 
 from obsync.logger import logger
 from obsync.config import config
+from .migrations import migrate
 
 db_file_path = os.path.join(config.DataDir, "vaults.db")
 DATABASE_URL = f"sqlite:///{db_file_path}"
 
-# NOTE Enable sqlite log: echo->INFO
-engine = create_engine(DATABASE_URL, echo=False)
+# Keep IN (...) lists well below SQLite's bound-parameter limit
+CHUNK_SIZE = 500
+
+
+def _create_engine(pool_size: int, readonly: bool):
+    # NOTE Enable sqlite log: echo->INFO
+    engine = create_engine(
+        DATABASE_URL,
+        echo=False,
+        pool_size=pool_size,
+        max_overflow=0,
+        connect_args={
+            "check_same_thread": False,
+            "timeout": config.DBBusyTimeoutMs / 1000,
+        },
+    )
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA journal_mode = {config.DBJournalMode}")
+        cursor.execute(f"PRAGMA synchronous = {config.DBSynchronous}")
+        cursor.execute(f"PRAGMA busy_timeout = {config.DBBusyTimeoutMs}")
+        cursor.execute(f"PRAGMA mmap_size = {config.DBMmapBytes}")
+        # Negative cache_size is in KiB rather than pages
+        cursor.execute(f"PRAGMA cache_size = -{config.DBCacheBytes // 1024}")
+        if readonly:
+            cursor.execute("PRAGMA query_only = ON")
+        else:
+            # Transactions are begun by `begin_immediate` below, not by pysqlite
+            dbapi_connection.isolation_level = None
+        cursor.close()
+
+    if not readonly:
+
+        @event.listens_for(engine, "begin")
+        def begin_immediate(conn):
+            # Take the write lock up front, so what a transaction reads before it first writes
+            # cannot be changed by another process before it commits
+            if conn.get_execution_options().get("isolation_level") != "AUTOCOMMIT":
+                conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+    return engine
+
+
+# SQLite allows one writer at a time; in WAL mode readers never wait for it.
+# Writes share a single connection and thread, reads get a pool of their own.
+# Each write transaction holds the write lock from its start, also against other workers.
+engine = _create_engine(pool_size=1, readonly=False)
+read_engine = _create_engine(pool_size=config.DBReaders, readonly=True)
 SessionFactory = sessionmaker(bind=engine)
+ReadSessionFactory = sessionmaker(bind=read_engine)
 
 
 Base = declarative_base()
@@ -21,18 +74,50 @@ Base = declarative_base()
 def init_db():
     try:
         Base.metadata.create_all(engine)
-        logger.info("Database initialized.")
     except Exception as e:
         logger.error(f"Error initializing database: {e}")
+    # A failed migration leaves the schema behind the code, so refuse to start rather than serve it
+    try:
+        migrate(engine)
+    except Exception as e:
+        logger.error(f"Error migrating database: {e}")
+        raise
+    logger.info("Database initialized.")
+
+
+# Database work runs on these threads so blocking SQLite calls never stall the event loop
+db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="obsync-db")
+read_executor = ThreadPoolExecutor(
+    max_workers=config.DBReaders, thread_name_prefix="obsync-db-read"
+)
 
 
-def session_handler(func):
-    def wrapper(*args, **kwargs):
+def session_handler(func=None, *, readonly: bool = False):
+    """
+    Runs `func` with a fresh session on the database executor and returns a coroutine.
+    Use `@session_handler(readonly=True)` for queries that never write, so they are
+    served by the reader pool instead of queueing behind writes.
+    """
+    if func is None:
+        return functools.partial(session_handler, readonly=readonly)
+
+    factory, executor = (
+        (ReadSessionFactory, read_executor) if readonly else (SessionFactory, db_executor)
+    )
+
+    def run(*args, **kwargs):
         try:
-            with SessionFactory() as session:
+            with factory() as session:
                 return func(*args, **kwargs, session=session)
         except SQLAlchemyError as e:
             logger.error(f"Database error in {func.__name__}: {e}")
             raise
 
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            executor, functools.partial(run, *args, **kwargs)
+        )
+
     return wrapper
@@ -9,3 +9,11 @@ class SigninException(Exception):
 
     def __str__(self) -> str:
         return f"{self.retcode}: {self.message} for User `{self.email}`"
+
+
+class StorageLimitExceeded(Exception):
+    def __init__(self, vault_id: str):
+        self.vault_id: str = vault_id
+
+    def __str__(self) -> str:
+        return f"Vault `{self.vault_id}` storage limit exceeded"
@@ -0,0 +1,260 @@
+"""
+Versioned, in-place schema migrations for existing databases.
+
+The applied version is tracked in SQLite's `PRAGMA user_version`. Each migration
+must be idempotent, since fresh databases already get the latest schema from
+`Base.metadata.create_all`.
+"""
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection, Engine
+
+from obsync.logger import logger
+from obsync.storage import blobstore, codecs
+
+BATCH_SIZE = 100
+# Key in `Connection.info` of blobs a migration staged, placed once its transaction has committed
+STAGED = "obsync_staged_blobs"
+
+
+def _has_column(conn: Connection, table: str, column: str) -> bool:
+    return any(c["name"] == column for c in inspect(conn).get_columns(table))
+
+
+def _move_file_data_to_blobstore(conn: Connection) -> bool:
+    if not _has_column(conn, "files", "blob"):
+        conn.execute(text("ALTER TABLE files ADD COLUMN blob TEXT"))
+
+    moved = 0
+    while True:
+        rows = conn.execute(
+            text(
+                "SELECT uid, data FROM files WHERE data IS NOT NULL AND blob IS NULL LIMIT :n"
+            ),
+            {"n": BATCH_SIZE},
+        ).fetchall()
+        if not rows:
+            break
+        for uid, data in rows:
+            staged = blobstore.stage(data)
+            conn.execute(
+                text(
+                    "INSERT INTO blobs (hash, size, refcount) VALUES (:hash, :size, 1) "
+                    "ON CONFLICT (hash) DO UPDATE SET refcount = refcount + 1"
+                ),
+                {"hash": staged.hash, "size": staged.size},
+            )
+            conn.info[STAGED].append(staged)
+            conn.execute(
+                text("UPDATE files SET blob = :hash, data = NULL WHERE uid = :uid"),
+                {"hash": staged.hash, "uid": uid},
+            )
+        moved += len(rows)
+
+    if moved:
+        logger.info(f"Moved {moved} file revisions into the blob store")
+    return moved > 0
+
+
+def _add_file_indexes(conn: Connection) -> bool:
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_files_vault_newest_deleted ON files (vault_id, newest, deleted)"
+    ))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_files_vault_snapshot ON files (vault_id, is_snapshot)"
+    ))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_files_path_modified ON files (path, modified)"
+    ))
+    conn.execute(text("ANALYZE files"))
+    return False
+
+
+def _add_file_versions(conn: Connection) -> bool:
+    if not _has_column(conn, "files", "version"):
+        conn.execute(text("ALTER TABLE files ADD COLUMN version INTEGER NOT NULL DEFAULT 0"))
+        # Unknown history: treat existing rows as changed at the current vault version
+        conn.execute(text(
+            "UPDATE files SET version = "
+            "(SELECT version FROM vaults WHERE vaults.id = files.vault_id) "
+            "WHERE EXISTS (SELECT 1 FROM vaults WHERE vaults.id = files.vault_id)"
+        ))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_files_vault_version ON files (vault_id, version)"
+    ))
+    return False
+
+
+def _add_vault_path_index(conn: Connection) -> bool:
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_files_vault_path_modified ON files (vault_id, path, modified)"
+    ))
+    return False
+
+
+def _add_vault_usage(conn: Connection) -> bool:
+    if not _has_column(conn, "vaults", "used"):
+        conn.execute(text("ALTER TABLE vaults ADD COLUMN used INTEGER NOT NULL DEFAULT 0"))
+    conn.execute(text(
+        "UPDATE vaults SET used = "
+        "(SELECT coalesce(sum(size), 0) FROM files WHERE files.vault_id = vaults.id)"
+    ))
+    return False
+
+
+def _add_blob_deltas(conn: Connection) -> bool:
+    if not _has_column(conn, "blobs", "base"):
+        conn.execute(text("ALTER TABLE blobs ADD COLUMN base TEXT"))
+    if not _has_column(conn, "blobs", "depth"):
+        conn.execute(text("ALTER TABLE blobs ADD COLUMN depth INTEGER NOT NULL DEFAULT 0"))
+    return False
+
+
+def _add_codecs(conn: Connection) -> bool:
+    if not _has_column(conn, "blobs", "codec"):
+        conn.execute(text("ALTER TABLE blobs ADD COLUMN codec TEXT"))
+    if inspect(conn).has_table("publish_files") and not _has_column(conn, "publish_files", "codec"):
+        conn.execute(text("ALTER TABLE publish_files ADD COLUMN codec TEXT"))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_blobs_codec ON blobs (codec) WHERE codec IS NULL"
+    ))
+    return False
+
+
+PUBLISH_FILES_SCHEMA = """
+CREATE TABLE publish_files_new (
+    slug TEXT NOT NULL, path TEXT NOT NULL, ctime INTEGER NOT NULL, hash TEXT NOT NULL,
+    mtime INTEGER NOT NULL, size INTEGER NOT NULL, blob TEXT, deleted INTEGER,
+    PRIMARY KEY (slug, path)
+)
+"""
+
+
+def _stage_page(data, codec) -> blobstore.StagedBlob:
+    """Streams a page stored inline, as text or as compressed bytes, into a staged blob."""
+    writer = blobstore.BlobWriter()
+    try:
+        if codec not in (None, codecs.NONE):
+            decompressor = codecs.decompressor(codec)
+            for i in range(0, len(data), blobstore.COPY_SIZE):
+                writer.write(decompressor.decompress(data[i : i + blobstore.COPY_SIZE]))
+            writer.write(decompressor.flush())
+        elif isinstance(data, str):
+            for i in range(0, len(data), blobstore.COPY_SIZE):
+                writer.write(data[i : i + blobstore.COPY_SIZE].encode("utf-8"))
+        else:
+            writer.write(data or b"")
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.finish()
+
+
+def _move_publish_files_to_blobstore(conn: Connection) -> bool:
+    """
+    Rebuilds publish_files keyed by (site, path) instead of a globally unique path and slug,
+    with page content moved from the text `data` column into the blob store.
+    """
+    if not inspect(conn).has_table("publish_files"):
+        return False
+    has_data = _has_column(conn, "publish_files", "data")
+    if not has_data and not _has_column(conn, "publish_files", "codec"):
+        return False
+
+    conn.execute(text("DROP TABLE IF EXISTS publish_files_new"))
+    conn.execute(text(PUBLISH_FILES_SCHEMA))
+    if not has_data:
+        conn.execute(text(
+            "INSERT INTO publish_files_new (slug, path, ctime, hash, mtime, size, blob, deleted) "
+            "SELECT slug, path, ctime, hash, mtime, size, blob, deleted FROM publish_files"
+        ))
+    moved, last = 0, 0
+    while has_data:
+        rows = conn.execute(
+            text(
+                "SELECT rowid, slug, path, ctime, hash, mtime, size, data, codec FROM publish_files "
+                "WHERE rowid > :last ORDER BY rowid LIMIT :n"
+            ),
+            {"last": last, "n": BATCH_SIZE},
+        ).fetchall()
+        if not rows:
+            break
+        for row in rows:
+            staged = _stage_page(row.data, row.codec)
+            conn.info[STAGED].append(staged)
+            # Left uncompressed (codec NULL) for the recompression job
+            conn.execute(
+                text(
+                    "INSERT INTO blobs (hash, size, refcount, depth) VALUES (:hash, :size, 1, 0) "
+                    "ON CONFLICT (hash) DO UPDATE SET refcount = refcount + 1"
+                ),
+                {"hash": staged.hash, "size": staged.size},
+            )
+            conn.execute(
+                text(
+                    "INSERT OR REPLACE INTO publish_files_new (slug, path, ctime, hash, mtime, size, blob, deleted) "
+                    "VALUES (:slug, :path, :ctime, :hash, :mtime, :size, :blob, 0)"
+                ),
+                {
+                    "slug": row.slug, "path": row.path, "ctime": row.ctime, "hash": row.hash,
+                    "mtime": row.mtime, "size": staged.size, "blob": staged.hash,
+                },
+            )
+        moved += len(rows)
+        last = rows[-1].rowid
+
+    conn.execute(text("DROP TABLE publish_files"))
+    conn.execute(text("ALTER TABLE publish_files_new RENAME TO publish_files"))
+    if moved:
+        logger.info(f"Moved {moved} published files into the blob store")
+    return moved > 0
+
+
+def _drop_unused_file_indexes(conn: Connection) -> bool:
+    # Revisions are pruned by compaction and history is vault-scoped, so nothing reads these
+    conn.execute(text("DROP INDEX IF EXISTS ix_files_vault_snapshot"))
+    conn.execute(text("DROP INDEX IF EXISTS ix_files_path_modified"))
+    return False
+
+
+# Append only, never reorder: position + 1 is the schema version.
+# A migration returns True when the database file should be vacuumed afterwards.
+MIGRATIONS = [
+    _move_file_data_to_blobstore,
+    _add_file_indexes,
+    _add_file_versions,
+    _add_vault_path_index,
+    _add_vault_usage,
+    _add_blob_deltas,
+    _add_codecs,
+    _move_publish_files_to_blobstore,
+    _drop_unused_file_indexes,
+]
+
+
+def migrate(engine: Engine) -> None:
+    vacuum = False
+    with engine.connect() as conn:
+        version = conn.execute(text("PRAGMA user_version")).scalar()
+
+    for target, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        with engine.connect() as conn:
+            staged = conn.info[STAGED] = []
+            try:
+                with conn.begin():
+                    vacuum = migration(conn) or vacuum
+                    conn.execute(text(f"PRAGMA user_version = {target}"))
+            except BaseException:
+                for blob in staged:
+                    blobstore.discard(blob)
+                raise
+            finally:
+                del conn.info[STAGED]
+        # Only now that rows reference them, so a failed migration leaves no stray blobs behind
+        for blob in staged:
+            blobstore.place(blob)
+        logger.info(f"Database migrated to version {target}")
+
+    if vacuum:
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(text("VACUUM"))
+        logger.info("Database vacuumed.")
@@ -1,5 +1,6 @@
 from .vault import User, Share, Vault
 from .vaultfiles import File
+from .blobs import Blob
 from .publish import *
 
 from ..db import init_db
@@ -0,0 +1,19 @@
+from sqlalchemy import Column, Index, Integer, Text, text
+
+from ..db import Base
+
+
+class Blob(Base):
+    __tablename__ = "blobs"
+    __table_args__ = (
+        # Finds the blobs still waiting for the recompression job
+        Index("ix_blobs_codec", "codec", sqlite_where=text("codec IS NULL")),
+    )
+    hash = Column(Text, primary_key=True)
+    size = Column(Integer, nullable=False)
+    refcount = Column(Integer, nullable=False, default=0)
+    # Set when the blob is stored as a delta against another blob, which it holds a reference on
+    base = Column(Text, nullable=True)
+    depth = Column(Integer, nullable=False, default=0, server_default="0")
+    # Codec of the stored file; NULL until the blob has been considered for compression
+    codec = Column(Text, nullable=True)
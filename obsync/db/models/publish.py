@@ -15,11 +15,13 @@ class Site (Base):
     
 class PublishFile (Base):
     __tablename__ = "publish_files"
-    path = Column(Text, nullable=False, primary_key=True, unique=True)
+    # Site id, not the public slug
+    slug = Column(Text, nullable=False, primary_key=True)
+    path = Column(Text, nullable=False, primary_key=True)
     ctime = Column(Integer, nullable=False)
     hash = Column(Text, nullable=False)
     mtime = Column(Integer, nullable=False)
     size = Column(Integer, nullable=False)
-    data = Column(Text, nullable=False)
-    slug = Column(Text, nullable=False, unique=True)
-    deleted = Column(Integer)
\ No newline at end of file
+    # Content in the blob store, see obsync.db.blobs
+    blob = Column(Text, nullable=True)
+    deleted = Column(Integer)
@@ -23,6 +23,8 @@ class Vault(Base):
     size = Column(Integer, default=0)
     version = Column(Integer, nullable=False, default=0)
     keyhash = Column(Text, nullable=False)
+    # Bytes used by all stored revisions, kept up to date by every write to files
+    used = Column(Integer, nullable=False, default=0)
 
 
 class Share(Base):
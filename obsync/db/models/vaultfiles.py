@@ -7,6 +7,7 @@ from sqlalchemy import (
     ForeignKey,
     BigInteger,
     Text,
+    Index,
 )
 
 from ..db import Base
@@ -14,6 +15,13 @@ from ..db import Base
 
 class File(Base):
     __tablename__ = "files"
+    # Keep in sync with the index migrations in obsync/db/migrations.py.
+    # Every query is vault-scoped; (vault_id, path, modified) also serves lookups by path.
+    __table_args__ = (
+        Index("ix_files_vault_newest_deleted", "vault_id", "newest", "deleted"),
+        Index("ix_files_vault_version", "vault_id", "version"),
+        Index("ix_files_vault_path_modified", "vault_id", "path", "modified"),
+    )
     uid = Column(Integer, primary_key=True, autoincrement=True)
     vault_id = Column(Text)
     hash = Column(Text)
@@ -24,6 +32,11 @@ class File(Base):
     modified = Column(Integer)
     folder = Column(Boolean)
     deleted = Column(Boolean)
+    # NOTE: legacy inline content, new revisions reference the blob store instead
     data = Column(LargeBinary)
+    blob = Column(Text)
     newest = Column(Boolean, default=True)
+    # NOTE: no longer read or written, kept so existing databases need no table rebuild
     is_snapshot = Column(Boolean, default=False)
+    # Vault version that last changed this row, used as the incremental sync cursor
+    version = Column(Integer, nullable=False, default=0)
@@ -1,42 +1,213 @@
+import sys
 import time
 import uuid
+import json
+import threading
+from collections import OrderedDict
 
-from typing import List
+from typing import Any, Dict, List, Optional, Set, Tuple
 
+from sqlalchemy import func
 from sqlalchemy.orm import Session
 
 from obsync.config import config
-from obsync.db import session_handler
+from obsync.db import session_handler, CHUNK_SIZE
 from obsync.utils import milisec
+from obsync.storage import blobstore
+from obsync.storage.blobstore import StagedBlob
 
 from .models.publish import *
+from . import blobs
 
+# Pages up to this size are read whole when looked up, and so can be cached; larger ones are streamed
+INLINE_BYTES = 1048576
 
-@session_handler
-def get_file(siteID: str, path: str, session: Session = None) -> str | None:
-    s = (
-        session.query(PublishFile)
-        .filter(PublishFile.slug == siteID, PublishFile.path == path)
+
+def site_options(options: Optional[str]) -> dict:
+    """Parses `Site.options`, a JSON object; anything else reads as no options."""
+    try:
+        parsed = json.loads(options or "{}")
+    except ValueError:
+        return {}
+    return parsed if isinstance(parsed, dict) else {}
+
+
+class PublishedFile:
+    """
+    A published page as looked up for serving. `content` holds the page itself when it is small
+    enough to keep in memory; otherwise it is None and the page is streamed from `blob`.
+    """
+
+    def __init__(self, site_id: str, options: str, hash: str, mtime: int, size: int, blob: Optional[str]):
+        self.site_id = site_id
+        self.options = site_options(options)
+        self.hash = hash
+        self.mtime = mtime
+        self.size = size
+        self.blob = blob
+        self.content: Optional[bytes] = None
+
+
+class PageCache:
+    """
+    Size-bounded LRU of published pages and slugs keyed by (slug, path), with path None for
+    the slug itself. Entries are accounted by the size of their content, dropped by
+    the writes that change them, and expire after `ttl` seconds so changes made by other
+    worker processes show up.
+    """
+
+    def __init__(self, maxbytes: int, ttl: float = 30):
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[Tuple[str, Optional[str]], Tuple[Any, int, str, float]] = OrderedDict()
+        self._sites: Dict[str, Set[Tuple[str, Optional[str]]]] = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _drop(self, key: Tuple[str, Optional[str]]) -> None:
+        _, size, site_id, _ = self._entries.pop(key)
+        self.bytes -= size
+        keys = self._sites.get(site_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._sites[site_id]
+
+    def get(self, slug: str, path: Optional[str] = None) -> Any:
+        key = (slug, path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[3] < time.monotonic():
+                if entry is not None:
+                    self._drop(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def generation(self) -> int:
+        return self._generation
+
+    def put(self, slug: str, path: Optional[str], value: Any, site_id: str, size: int, generation: int) -> None:
+        key = (slug, path)
+        # Skip values loaded before an invalidation, and values that would crowd out everything else
+        if size > self.maxbytes // 8:
+            return
+        with self._lock:
+            if generation != self._generation:
+                return
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (value, size, site_id, time.monotonic() + self.ttl)
+            self._sites.setdefault(site_id, set()).add(key)
+            self.bytes += size
+            while self.bytes > self.maxbytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, site_id: str, path: Optional[str] = None) -> None:
+        """Drops one page of a site, or with no path everything cached for the site."""
+        with self._lock:
+            self._generation += 1
+            for key in list(self._sites.get(site_id, ())):
+                if path is None or key[1] == path:
+                    self._drop(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._sites.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "maxbytes": self.maxbytes,
+        }
+
+
+page_cache = PageCache(config.PublishCacheBytes)
+
+
+@session_handler(readonly=True)
+def _load_published_file(slug: str, path: str, session: Session = None) -> Optional[PublishedFile]:
+    row = (
+        session.query(Site.id, Site.options, PublishFile.hash, PublishFile.mtime, PublishFile.size, PublishFile.blob)
+        .outerjoin(PublishFile, (PublishFile.slug == Site.id) & (PublishFile.path == path))
+        .filter(Site.slug == slug)
         .first()
     )
-    return s.data if s is not None else None
+    if row is None:
+        return None
+    file = PublishedFile(*row)
+    if file.blob is not None and (file.size or 0) <= INLINE_BYTES:
+        # Read here, on the reader thread, so cached pages are served without any work
+        file.content = blobstore.read(file.blob)
+    return file
 
 
-@session_handler
-def new_file(file: PublishFile, session: Session = None) -> None:
-    file.ctime = milisec()
-    file.mtime = milisec()
+async def get_published_file(slug: str, path: str) -> Optional[PublishedFile]:
+    """
+    Resolves a public slug and a path in one query, or from the page cache. Returns None if the
+    site does not exist, and a PublishedFile without a hash if the site exists but the page does not.
+    """
+    file = page_cache.get(slug, path)
+    if file is None:
+        generation = page_cache.generation()
+        try:
+            file = await _load_published_file(slug, path)
+        except FileNotFoundError:
+            # Replaced between the query and the read; a fresh query sees the new version
+            file = await _load_published_file(slug, path)
+        if file is not None and (file.blob is None or file.content is not None):
+            size = len(file.content or b"") + sys.getsizeof(path) + sys.getsizeof(file.hash)
+            page_cache.put(slug, path, file, file.site_id, size, generation)
+    return file
 
-    session.merge(file)
-    session.commit()
+
+@session_handler
+def new_file(file: PublishFile, staged: StagedBlob, session: Session = None) -> None:
+    """Stores an uploaded page and its staged content in one transaction, replacing any previous version."""
+    now = milisec()
+    try:
+        file.blob = blobs.attach(session, staged)
+        previous = (
+            session.query(PublishFile.blob, PublishFile.ctime)
+            .filter(PublishFile.slug == file.slug, PublishFile.path == file.path)
+            .first()
+        )
+        if previous is not None:
+            blobs.release(session, [previous.blob])
+        file.ctime = previous.ctime if previous is not None else now
+        file.mtime = now
+        session.merge(file)
+        session.commit()
+        page_cache.invalidate(file.slug, file.path)
+    finally:
+        blobstore.discard(staged)
 
 
 @session_handler
 def remove_file(siteID: str, path: str, session: Session) -> None:
-    session.query(PublishFile).filter(
+    query = session.query(PublishFile).filter(
         PublishFile.slug == siteID, PublishFile.path == path
-    ).delete()
+    )
+    blobs.release(session, [row.blob for row in query.with_entities(PublishFile.blob)])
+    query.delete()
     session.commit()
+    page_cache.invalidate(siteID, path)
 
 
 @session_handler
@@ -57,46 +228,138 @@ def create_site(owner: str, session: Session) -> Site:
 
 @session_handler
 def delete_site(siteID: str, session: Session) -> None:
+    files = session.query(PublishFile).filter(PublishFile.slug == siteID)
+    blobs.release(session, [row.blob for row in files.with_entities(PublishFile.blob)])
+    files.delete()
     session.query(Site).filter(Site.id == siteID).delete()
     session.commit()
+    page_cache.invalidate(siteID)
 
 
 class SlugResponse:
-    def __init__(self, id: str, host: str, slug: str):
+    def __init__(self, id: str, host: str, slug: str, options: str = ""):
         self.id = id
         self.host = host
         self.slug = slug
+        self.options = options
 
 
-@session_handler
-def get_slug(slug: str, session: Session = None) -> SlugResponse | None:
+@session_handler(readonly=True)
+def _load_slug(slug: str, session: Session = None) -> SlugResponse | None:
     site = session.query(Site).filter(Site.slug == slug).first()
     if site is None:
         return None
-    return SlugResponse(site.id, site.host, site.slug)
+    return SlugResponse(site.id, site.host, site.slug, site.options)
+
+
+async def get_slug(slug: str) -> SlugResponse | None:
+    site = page_cache.get(slug)
+    if site is None:
+        generation = page_cache.generation()
+        site = await _load_slug(slug)
+        if site is not None:
+            size = sum(sys.getsizeof(v) for v in vars(site).values())
+            page_cache.put(slug, None, site, site.id, size, generation)
+    return site
 
 
 @session_handler
 def set_slug(slug: str, id: str, session: Session = None) -> None:
     session.query(Site).filter(Site.id == id).update({"slug": slug})
     session.commit()
+    page_cache.invalidate(id)
 
 
 @session_handler
+def set_site_option(id: str, key: str, value, session: Session = None) -> None:
+    site = session.query(Site).filter(Site.id == id).first()
+    options = site_options(site.options)
+    options[key] = value
+    site.options = json.dumps(options)
+    session.commit()
+    page_cache.invalidate(id)
+
+
+@session_handler(readonly=True)
 def get_sites(userEmail: str, session: Session = None) -> List[Site]:
     return session.query(Site).filter(Site.owner == userEmail).all()
 
 
-@session_handler
+@session_handler(readonly=True)
 def get_site_owner(siteID: str, session: Session = None) -> str:
     return session.query(Site).filter(Site.id == siteID).first().owner
 
 
-@session_handler
+@session_handler(readonly=True)
 def get_site_slug(siteID: str, session: Session = None) -> str:
     return session.query(Site).filter(Site.id == siteID).first().slug
 
 
-@session_handler
-def get_files(siteID: str, session: Session = None) -> List[PublishFile]:
-    return session.query(PublishFile).filter(PublishFile.slug == siteID).all()
+@session_handler(readonly=True)
+def get_site_slugs(siteIDs: List[str], session: Session = None) -> Dict[str, str]:
+    """Maps site ids to their slugs in one session, skipping ids of sites that do not exist."""
+    ids = list(dict.fromkeys(siteIDs))
+    slugs = {}
+    for i in range(0, len(ids), CHUNK_SIZE):
+        chunk = ids[i : i + CHUNK_SIZE]
+        slugs.update(session.query(Site.id, Site.slug).filter(Site.id.in_(chunk)).all())
+    return slugs
+
+
+@session_handler(readonly=True)
+def get_files_stamp(siteID: str, session: Session = None) -> Tuple[int, int, int]:
+    """
+    Returns (count, latest mtime, sum of mtimes) of a site's files, which changes whenever a file
+    is added, replaced or removed, without reading the listing itself.
+    """
+    count, latest, total = (
+        session.query(
+            func.count(PublishFile.path),
+            func.coalesce(func.max(PublishFile.mtime), 0),
+            func.coalesce(func.sum(PublishFile.mtime), 0),
+        )
+        .filter(PublishFile.slug == siteID)
+        .one()
+    )
+    return count, latest, total
+
+
+# Columns of a site listing, in the order `get_files` returns them
+FILE_FIELDS = ("path", "hash", "size", "ctime", "mtime")
+
+
+def _prefix_end(prefix: str) -> Optional[str]:
+    """The smallest string greater than every string starting with `prefix`, or None if there is none."""
+    while prefix:
+        last = ord(prefix[-1])
+        if last < sys.maxunicode:
+            # Step over the surrogates, which SQLite cannot bind
+            return prefix[:-1] + chr(0xE000 if last == 0xD7FF else last + 1)
+        prefix = prefix[:-1]
+    return None
+
+
+@session_handler(readonly=True)
+def get_files(
+    siteID: str, prefix: str = "", after: str = "", limit: Optional[int] = None, session: Session = None
+) -> Tuple[List[tuple], bool]:
+    """
+    Returns the metadata of a site's files in path order, as FILE_FIELDS tuples, and whether
+    more follow. Pass the last path of a page as `after` to fetch the next one.
+    """
+    query = session.query(
+        PublishFile.path, PublishFile.hash, PublishFile.size, PublishFile.ctime, PublishFile.mtime
+    ).filter(PublishFile.slug == siteID)
+    # Path ranges rather than LIKE, which SQLite matches case-insensitively and cannot serve from the key
+    if prefix:
+        query = query.filter(PublishFile.path >= prefix)
+        end = _prefix_end(prefix)
+        if end is not None:
+            query = query.filter(PublishFile.path < end)
+    if after:
+        query = query.filter(PublishFile.path > after)
+    query = query.order_by(PublishFile.path)
+    if limit is None:
+        return [tuple(row) for row in query.all()], False
+    rows = query.limit(limit + 1).all()
+    return [tuple(row) for row in rows[:limit]], len(rows) > limit
@@ -1,7 +1,9 @@
 import uuid
 import time
 import bcrypt
-from typing import List
+import threading
+from typing import Dict, List, Optional, Set
+from sqlalchemy import func
 from sqlalchemy.orm import Session
 
 from obsync.utils import MakeKeyHash, milisec
@@ -13,6 +15,114 @@ from .models.vault import User, Vault, Share
 from .exceptions import *
 
 
+class CachedVault:
+    def __init__(self, info: VaultInfo, owner: str, shares: Set[str], expires: float):
+        self.info = info
+        self.owner = owner
+        self.shares = shares
+        self.expires = expires
+
+
+class VaultCache:
+    """
+    Process-local copy of the vault metadata every websocket connect needs: keyhash, version,
+    owner and share ACL. Writers update it (version) or invalidate it (everything else).
+    Entries also expire after `ttl` seconds so changes made by other worker processes show up;
+    when workers share broadcasts the version and ACL are read fresh instead, see `_shared`.
+    """
+
+    def __init__(self, ttl: float = 30):
+        self.ttl = ttl
+        self._entries: Dict[str, CachedVault] = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, vault_id: str) -> Optional[CachedVault]:
+        with self._lock:
+            entry = self._entries.get(vault_id)
+            if entry is not None and entry.expires < time.monotonic():
+                del self._entries[vault_id]
+                return None
+            return entry
+
+    def generation(self) -> int:
+        return self._generation
+
+    def put(self, vault_id: str, entry: CachedVault, generation: int) -> None:
+        # Skip entries loaded before an invalidation, they may already be stale
+        with self._lock:
+            if generation == self._generation:
+                self._entries[vault_id] = entry
+
+    def set_version(self, vault_id: str, version: int) -> None:
+        with self._lock:
+            # A load already running may have read the old version, so it must not be cached
+            self._generation += 1
+            entry = self._entries.get(vault_id)
+            if entry is not None and version > entry.info.version:
+                entry.info.version = version
+
+    def invalidate(self, vault_id: str) -> None:
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(vault_id, None)
+
+
+vault_cache = VaultCache()
+
+
+@session_handler(readonly=True)
+def _load_vault(vault_id: str, session: Session) -> Optional[CachedVault]:
+    vault = session.query(Vault).filter(Vault.id == vault_id).first()
+    if vault is None:
+        return None
+    shares = session.query(Share.email).filter(Share.vault_id == vault_id)
+    return CachedVault(
+        info=VaultInfo(
+            id=vault.id,
+            created=vault.created,
+            host=vault.host,
+            name=vault.name,
+            password=vault.password,
+            salt=vault.salt,
+            size=vault.size,
+            keyhash=vault.keyhash,
+            version=vault.version,
+        ),
+        owner=vault.user_email,
+        shares={share.email for share in shares},
+        expires=time.monotonic() + vault_cache.ttl,
+    )
+
+
+def _shared() -> bool:
+    # Other worker processes write too, so versions and shares cached here may be behind
+    return config.BroadcastBackend != "local"
+
+
+@session_handler(readonly=True)
+def _load_version(vault_id: str, session: Session) -> Optional[int]:
+    return session.query(Vault.version).filter(Vault.id == vault_id).scalar()
+
+
+@session_handler(readonly=True)
+def _load_access(vault_id: str, email: str, session: Session) -> bool:
+    owned = session.query(Vault.id).filter(Vault.id == vault_id, Vault.user_email == email).first()
+    return owned is not None or (
+        session.query(Share.uid).filter(Share.vault_id == vault_id, Share.email == email).first() is not None
+    )
+
+
+async def _cached_vault(vault_id: str) -> Optional[CachedVault]:
+    entry = vault_cache.get(vault_id)
+    if entry is None:
+        generation = vault_cache.generation()
+        entry = await _load_vault(vault_id)
+        if entry is not None:
+            vault_cache.put(vault_id, entry, generation)
+    return entry
+
+
 @session_handler
 def share_vault_invite(
     email: str, name: str, vault_id: str, session: Session
@@ -21,6 +131,7 @@ def share_vault_invite(
 
     session.add(new_share)
     session.commit()
+    vault_cache.invalidate(vault_id)
 
 
 @session_handler
@@ -34,15 +145,16 @@ def share_vault_revoke(
             Share.vault_id == vault_id, Share.email == email
         ).delete()
     session.commit()
+    vault_cache.invalidate(vault_id)
 
 
-@session_handler
+@session_handler(readonly=True)
 def get_vault_shares(vault_id: str, session: Session) -> List[Share]:
     shares = session.query(Share).filter(Share.vault_id == vault_id).all()
     return shares
 
 
-@session_handler
+@session_handler(readonly=True)
 def get_shared_vaults(email: str, session: Session) -> List[VaultInfo]:
     vaults = (
         session.query(Vault)
@@ -64,17 +176,15 @@ def get_shared_vaults(email: str, session: Session) -> List[VaultInfo]:
     ]
 
 
-@session_handler
-def has_access_to_vault(vault_id: str, email: str, session: Session) -> bool:
-    row = (
-        session.query(Vault)
-        .filter(Vault.id == vault_id, Vault.user_email == email)
-        .first()
-    )
-    return row is not None
+async def has_access_to_vault(vault_id: str, email: str) -> bool:
+    if _shared():
+        # Never trust another worker's revocation to have reached this cache
+        return await _load_access(vault_id, email)
+    entry = await _cached_vault(vault_id)
+    return entry is not None and (entry.owner == email or email in entry.shares)
 
 
-@session_handler
+@session_handler(readonly=True)
 def is_vault_owner(vault_id: str, email: str, session: Session) -> bool:
     row = (
         session.query(Vault)
@@ -92,13 +202,13 @@ def new_user(email: str, password: str, name: str, session: Session) -> None:
     session.commit()
 
 
-@session_handler
+@session_handler(readonly=True)
 def user_info(email: str, session: Session) -> User:
     user = session.query(User).filter(User.email == email).first()
     return user
 
 
-@session_handler
+@session_handler(readonly=True)
 def login(email: str, password: str, session: Session) -> User:
     user = session.query(User).filter(User.email == email).first()
     if user is None or not bcrypt.checkpw(password.encode(), user.password.encode()):
@@ -141,7 +251,8 @@ def new_vault(
     )
     session.add(vault)
     session.commit()
-    
+    vault_cache.invalidate(vault.id)
+
     return VaultInfo(
         id=vault.id,
         created=vault.created,
@@ -160,32 +271,40 @@ def delete_vault(vault_id: str, email: str, session: Session) -> None:
         Vault.id == vault_id, Vault.user_email == email
     ).delete()
     session.commit()
+    vault_cache.invalidate(vault_id)
 
 # TODO: 不设置vault密码时会报错 keyhash not match
-@session_handler
-def get_vault(vault_id: str, keyhash: str, session: Session) -> Vault:
-    vault = session.query(Vault).filter(Vault.id == vault_id).first()
-    if vault.keyhash != keyhash:
+async def get_vault(vault_id: str, keyhash: str) -> VaultInfo:
+    entry = await _cached_vault(vault_id)
+    if entry is None:
+        raise Exception("vault not found")
+    if entry.info.keyhash != keyhash:
         raise Exception("keyhash not match")
-    return VaultInfo(
-        id=vault.id,
-        created=vault.created,
-        host=vault.host,
-        name=vault.name,
-        password=vault.password,
-        salt=vault.salt,
-        size=vault.size,
-        version=vault.version,
-    ) # type: ignore
+    update = {"keyhash": None}
+    if _shared():
+        version = await _load_version(vault_id)
+        if version is None:
+            raise Exception("vault not found")
+        update["version"] = version
+    return entry.info.model_copy(update=update)
 
 
 @session_handler
 def set_vault_version(id: str, ver: int, session: Session) -> None:
-    session.query(Vault).filter(Vault.id == id).update({Vault.version: ver})
+    # Never move backwards, a stale reader must not undo newer pushes
+    session.query(Vault).filter(Vault.id == id).update(
+        {Vault.version: func.max(Vault.version, ver)}
+    )
     session.commit()
+    vault_cache.set_version(id, ver)
 
 
-@session_handler
+@session_handler(readonly=True)
+def get_vault_ids(session: Session) -> List[str]:
+    return [row.id for row in session.query(Vault.id)]
+
+
+@session_handler(readonly=True)
 def get_vaults(email: str, session: Session) -> List[VaultInfo]:
     vaults = session.query(Vault).filter(Vault.user_email == email).all()
     return [
@@ -1,41 +1,99 @@
-from typing import List
-from sqlalchemy import func
+from typing import List, Optional, Tuple
+from sqlalchemy import delete, func, and_, or_, tuple_
 from sqlalchemy.orm import Session
 
 from obsync.schemas.vaultfiles import FileResponse, HistoryFileResponse, FileInfo
 from obsync.logger import logger
 from obsync.db import session_handler
 from obsync.utils import milisec
+from obsync.storage import blobstore
+from obsync.storage.blobstore import StagedBlob
 
 from .models.vaultfiles import File
+from .models.vault import Vault
+from .vault import vault_cache
+from .exceptions import StorageLimitExceeded
+from . import blobs
 
 
-@session_handler
-def snap_shot(vault_id: str, session: Session) -> None:
-    session.query(File).filter(File.vault_id == vault_id, File.newest == True).update(
-        {"is_snapshot": True}
+def _next_version(session: Session, vault_id: str) -> int:
+    """
+    Bumps the vault version inside the caller's write transaction and returns it,
+    so every change is tagged with the version that introduced it.
+    """
+    session.query(Vault).filter(Vault.id == vault_id).update(
+        {Vault.version: Vault.version + 1}
     )
-    session.query(File).filter(
-        File.vault_id == vault_id, File.is_snapshot == False
-    ).delete()
-    session.query(File).filter(
-        File.vault_id == vault_id, File.size != 0, File.data == None
-    ).delete()
-    session.commit()
+    return session.query(Vault.version).filter(Vault.id == vault_id).scalar()
+
+
+def _add_usage(session: Session, vault_id: str, size: int) -> None:
+    """Adjusts the vault's usage counter inside the caller's write transaction."""
+    if size:
+        session.query(Vault).filter(Vault.id == vault_id).update(
+            {Vault.used: Vault.used + size}
+        )
+
+
+@session_handler
+def compact_vault(
+    vault_id: str, keep: int, before: int, limit: int, cursor: Optional[tuple] = None, session: Session = None
+) -> Tuple[int, Optional[tuple]]:
+    """
+    Walks the next `limit` revisions of the vault, newest first within each path, and deletes
+    those that are neither among the `keep` newest of their path nor modified after `before`,
+    plus uploads that never got content. Returns the number of rows deleted and the cursor of
+    the next slice, or None once the whole vault has been walked.
+    """
+    query = session.query(
+        File.uid, File.path, File.modified, File.blob, File.newest, File.size,
+        (File.data == None).label("no_data"),
+    ).filter(File.vault_id == vault_id)
+    path, rank = None, 0
+    if cursor is not None:
+        path, modified, uid, rank = cursor
+        # Keyset over (path, modified, uid), read backwards along ix_files_vault_path_modified
+        query = query.filter(tuple_(File.path, File.modified, File.uid) < tuple_(path, modified, uid))
+    rows = query.order_by(File.path.desc(), File.modified.desc(), File.uid.desc()).limit(limit).all()
+
+    expired = []
+    for row in rows:
+        # Ranks carry over from the previous slice while it ended inside the same path
+        rank = rank + 1 if row.path == path else 1
+        path = row.path
+        if (
+            not row.newest and rank > keep and row.modified is not None and row.modified < before
+        ) or (row.size and row.blob is None and row.no_data):
+            expired.append(row)
+
+    removed = []
+    if expired:
+        # Release only what this DELETE removed, never rows another writer got to first
+        removed = session.execute(
+            delete(File).where(File.uid.in_([row.uid for row in expired])).returning(File.blob, File.size)
+        ).all()
+        blobs.release(session, [row.blob for row in removed])
+        _add_usage(session, vault_id, -sum(row.size or 0 for row in removed))
+        session.commit()
+    if len(rows) < limit:
+        return len(removed), None
+    last = rows[-1]
+    return len(removed), (last.path, last.modified, last.uid, rank)
 
 
 @session_handler
 def restore_file(uid: int, session: Session) -> FileResponse:
-    file = session.query(File.uid, File.path, File.hash, File.extension, File.size, File.created, File.modified, File.folder, File.deleted).filter(File.uid == uid).first()
-    
+    file = session.query(File.uid, File.vault_id, File.path, File.hash, File.extension, File.size, File.created, File.modified, File.folder, File.deleted).filter(File.uid == uid).first()
+
+    session.query(File).filter(
+        File.vault_id == file.vault_id, File.path == file.path, File.newest == True
+    ).update({"newest": False})
+    version = _next_version(session, file.vault_id)
     session.query(File).filter(File.uid == uid).update(
-        {"deleted": False, "newest": True}
+        {"deleted": False, "newest": True, "version": version}
     )
     session.commit()
-    # TODO: check if this is correct
-    session.query(File).filter(File.path == file.path, File.deleted == False).update(
-        {"newest": False}
-    )
+    vault_cache.set_version(file.vault_id, version)
     return FileResponse(
         uid = file.uid,
         hash= file.hash,
@@ -45,82 +103,147 @@ def restore_file(uid: int, session: Session) -> FileResponse:
         created = file.created,
         modified = file.modified,
         folder = file.folder,
-        deleted = file.deleted,
+        deleted = False,
         op = "push",
     )
 
 
-@session_handler
+@session_handler(readonly=True)
 def get_vault_size(vault_id: str, session: Session) -> int:
+    return session.query(Vault.used).filter(Vault.id == vault_id).scalar() or 0
+
+
+@session_handler
+def recompute_vault_size(vault_id: str, session: Session) -> int:
+    """Rebuilds the usage counter from the stored revisions, for repairs."""
     size = (
         session.query(func.coalesce(func.sum(File.size), 0))
         .filter(File.vault_id == vault_id)
         .scalar()
     )
+    session.query(Vault).filter(Vault.id == vault_id).update({Vault.used: size})
+    session.commit()
     return size
 
 
-@session_handler
-def get_vault_files(vault_id: str, session: Session) -> List[FileInfo]:
-    files = (
-        session.query(File)
-        .filter(File.vault_id == vault_id, File.deleted == False, File.newest == True)
-        .all()
+@session_handler(readonly=True)
+def get_vault_files(
+    vault_id: str,
+    since: int = 0,
+    after: int = 0,
+    limit: Optional[int] = None,
+    session: Session = None,
+) -> List[FileInfo]:
+    """
+    Returns metadata (never content) of the newest revision of every file changed after vault
+    version `since`, ordered by uid. Pass the last uid of a page as `after` to fetch the next one.
+    A client starting from scratch (`since == 0`) does not need to hear about deletions.
+    """
+    query = session.query(
+        File.uid, File.hash, File.path, File.size, File.created, File.modified, File.folder, File.deleted
+    ).filter(
+        File.vault_id == vault_id, File.newest == True, File.version > since, File.uid > after
     )
+    if since == 0:
+        query = query.filter(File.deleted == False)
+    files = query.order_by(File.uid).limit(limit).all()
     return [
         FileInfo(
             uid=file.uid,
-            vault_id=file.vault_id,
+            vault_id=vault_id,
             hash=file.hash,
             path=file.path,
-            extension=file.extension,
             size=file.size,
             created=file.created,
             modified=file.modified,
             folder=file.folder,
             deleted=file.deleted,
-            data=file.data,
-            newest=file.newest,
-            is_snapshot=file.is_snapshot,
+            newest=True,
         )
         for file in files
     ]
 
 
-@session_handler
+@session_handler(readonly=True)
 def get_file(uid: int, session: Session) -> FileInfo:
-    file:File = session.query(File.hash, File.size, File.data).filter(File.uid == uid).first()
+    file:File = session.query(File.hash, File.size, File.blob, File.data).filter(File.uid == uid).first()
     return FileInfo(
         hash=file.hash,
         size=file.size,
         data=file.data,
+        blob=file.blob,
     )
 
 
-
-@session_handler
-def get_file_history(path: str, session: Session) -> List[HistoryFileResponse]:
-    # err := db.Model(&File{}).Select("uid, path, size, modified, folder, deleted").Where("path = ?", path).Order("modified DESC").Find(&files).Error
-    files = (
-        session.query(File.uid, File.path, File.size, File.modified, File.folder, File.deleted).filter(File.path == path).order_by(File.modified.desc()).all()
+@session_handler(readonly=True)
+def get_revision_blob(vault_id: str, path: str, hash: str, session: Session) -> Optional[str]:
+    """Returns the stored blob of the latest revision of `path` whose client hash is `hash`, if any."""
+    return (
+        session.query(File.blob)
+        .filter(File.vault_id == vault_id, File.path == path, File.hash == hash, File.blob != None)
+        .order_by(File.modified.desc())
+        .limit(1)
+        .scalar()
     )
+
+
+@session_handler(readonly=True)
+def get_file_history(
+    vault_id: str, path: str, last: int = 0, limit: int = 100, session: Session = None
+) -> Tuple[List[HistoryFileResponse], bool]:
+    """
+    Returns one page of the revisions of `path`, newest first, and whether more follow.
+    Pass the uid of the last revision of a page as `last` to fetch the next one; a `last` that
+    is not a revision of `path` ends the listing rather than restarting it.
+    """
+    query = session.query(
+        File.uid, File.path, File.size, File.modified, File.folder, File.deleted
+    ).filter(File.vault_id == vault_id, File.path == path)
+    if last:
+        modified = (
+            session.query(File.modified)
+            .filter(File.uid == last, File.vault_id == vault_id, File.path == path)
+            .scalar()
+        )
+        if modified is None:
+            return [], False
+        # Keyset over (modified, uid), served by ix_files_vault_path_modified
+        query = query.filter(
+            or_(File.modified < modified, and_(File.modified == modified, File.uid < last))
+        )
+    files = query.order_by(File.modified.desc(), File.uid.desc()).limit(limit + 1).all()
     history = [
         HistoryFileResponse(
             uid=file.uid,
             path=file.path,
+            size=file.size,
             modified=file.modified,
             folder=file.folder,
             deleted=file.deleted,
             ts=file.modified,
         )
-        for file in files
+        for file in files[:limit]
     ]
-    return history
+    return history, len(files) > limit
 
 
-@session_handler
-def get_deleted_files(session: Session) -> List[dict]:
-    files = session.query(File).filter(File.deleted == True, File.newest == True).all()
+@session_handler(readonly=True)
+def get_deleted_files(
+    vault_id: str, after: int = 0, limit: Optional[int] = None, session: Session = None
+) -> List[dict]:
+    """
+    Returns the deleted files of the vault ordered by uid, served by ix_files_vault_newest_deleted.
+    Pass the last uid of a page as `after` to fetch the next one.
+    """
+    files = (
+        session.query(File.uid, File.modified, File.size, File.path, File.folder, File.deleted)
+        .filter(
+            File.vault_id == vault_id, File.newest == True, File.deleted == True, File.uid > after
+        )
+        .order_by(File.uid)
+        .limit(limit)
+        .all()
+    )
     return [
         {
             "uid": file.uid,
@@ -135,30 +258,50 @@ def get_deleted_files(session: Session) -> List[dict]:
 
 
 @session_handler
-def insert_metadata(file: File, session: Session) -> int:
+def insert_metadata(
+    file: File, staged: Optional[StagedBlob] = None, limit: Optional[int] = None, session: Session = None
+) -> int:
+    """
+    Inserts a new revision and, if given, its staged content in one transaction,
+    so a revision never becomes visible without its data. The revision is charged at the
+    size of its stored content; with `limit` set, raises StorageLimitExceeded instead when
+    that would take the vault past it.
+    """
     current_time = milisec()
     if file.created == 0:
         file.created = current_time
     if file.modified == 0:
         file.modified = current_time
 
-    session.query(File).filter(File.path == file.path, File.newest == True).update(
-        {"newest": False}
-    )
-    session.add(file)
-    session.commit()
+    try:
+        if staged is not None:
+            file.size = staged.size
+        if limit is not None:
+            # Checked and charged in the one write transaction, so concurrent pushes cannot both fit
+            used = session.query(Vault.used).filter(Vault.id == file.vault_id).scalar() or 0
+            if file.size and used + file.size > limit:
+                raise StorageLimitExceeded(file.vault_id)
+        if staged is not None:
+            file.blob = blobs.attach(session, staged)
+        session.query(File).filter(
+            File.vault_id == file.vault_id, File.path == file.path, File.newest == True
+        ).update({"newest": False})
+        file.version = _next_version(session, file.vault_id)
+        _add_usage(session, file.vault_id, file.size or 0)
+        session.add(file)
+        session.commit()
+        vault_cache.set_version(file.vault_id, file.version)
+    finally:
+        if staged is not None:
+            blobstore.discard(staged)
     return file.uid
 
 
 @session_handler
-def insert_data(uid: int, data: bytes, session: Session):
-    session.query(File).filter(File.uid == uid).update({"data": data})
-    session.commit()
-
-
-@session_handler
-def delete_vault_file(path: str, session: Session):
-    session.query(File).filter(File.path == path).update(
-        {"deleted": True, "is_snapshot": True}
+def delete_vault_file(vault_id: str, path: str, session: Session):
+    version = _next_version(session, vault_id)
+    session.query(File).filter(File.vault_id == vault_id, File.path == path).update(
+        {"deleted": True, "version": version}
     )
     session.commit()
+    vault_cache.set_version(vault_id, version)
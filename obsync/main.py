@@ -1,9 +1,30 @@
 import uvicorn
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from starlette.middleware.cors import CORSMiddleware
 from obsync.routes import *
-
-app = FastAPI()
+from obsync.logger import logger
+from obsync.storage import blobstore
+from obsync.tasks import compaction, recompression, leader
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # With several workers, only one of them runs the background jobs
+    if leader.acquire():
+        # Only old files, as other workers may be midway through uploads of their own
+        swept = blobstore.sweep_tmp()
+        if swept:
+            logger.info(f"Removed {swept} stale temp files")
+        compaction.start()
+        recompression.start()
+    yield
+    recompression.stop()
+    compaction.stop()
+    leader.release()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -0,0 +1 @@
+from .backends import BroadcastBackend, LocalBackend, SQLiteBackend, get_backend
@@ -0,0 +1,145 @@
+import os
+import time
+import uuid
+import asyncio
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from typing import Callable, Optional
+
+from obsync.config import config
+from obsync.logger import logger
+
+
+# Called with (channel, message) for every broadcast, local or remote
+Deliver = Callable[[str, str], None]
+
+
+class BroadcastBackend(ABC):
+    """
+    Carries serialized broadcasts between every process serving websockets.
+    `start` is idempotent and is called before each use; `publish` delivers to the
+    local process immediately and to other processes through the backend.
+    """
+
+    def __init__(self):
+        self.deliver: Optional[Deliver] = None
+
+    async def start(self, deliver: Deliver) -> None:
+        self.deliver = deliver
+
+    @abstractmethod
+    async def publish(self, channel: str, message: str) -> None:
+        ...
+
+    @abstractmethod
+    async def stop(self) -> None:
+        ...
+
+
+class LocalBackend(BroadcastBackend):
+    """In-process only, for a single worker."""
+
+    async def publish(self, channel: str, message: str) -> None:
+        self.deliver(channel, message)
+
+    async def stop(self) -> None:
+        pass  # NOTE: nothing to release
+
+
+class SQLiteBackend(BroadcastBackend):
+    """
+    Shares broadcasts between processes on one host through an append-only table in
+    a small WAL-mode SQLite file, which each process tails by polling.
+    """
+
+    def __init__(self, path: str, poll_interval: float = 0.05, retention: float = 60):
+        super().__init__()
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.origin = uuid.uuid4().hex
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode = WAL")
+            self._conn.execute("PRAGMA synchronous = NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, origin TEXT NOT NULL, "
+                "channel TEXT NOT NULL, message TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self._last = self._conn.execute(
+                "SELECT coalesce(max(id), 0) FROM messages"
+            ).fetchone()[0]
+
+    async def start(self, deliver: Deliver) -> None:
+        await super().start(deliver)
+        loop = asyncio.get_running_loop()
+        if self._task is not None and not self._task.done() and self._loop is loop:
+            return
+        self._loop = loop
+        self._task = loop.create_task(self._poll())
+
+    async def publish(self, channel: str, message: str) -> None:
+        self.deliver(channel, message)
+        await asyncio.to_thread(self._insert, channel, message)
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def _insert(self, channel: str, message: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO messages (origin, channel, message, created) VALUES (?, ?, ?, ?)",
+                (self.origin, channel, message, time.time()),
+            )
+
+    def _fetch(self) -> list:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, origin, channel, message FROM messages WHERE id > ? ORDER BY id",
+                (self._last,),
+            ).fetchall()
+        if rows:
+            self._last = rows[-1][0]
+        return [(channel, message) for _, origin, channel, message in rows if origin != self.origin]
+
+    def _prune(self) -> None:
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM messages WHERE created < ?", (time.time() - self.retention,)
+            )
+
+    async def _poll(self):
+        pruned = time.monotonic()
+        while True:
+            try:
+                for channel, message in await asyncio.to_thread(self._fetch):
+                    self.deliver(channel, message)
+                if time.monotonic() - pruned > self.retention:
+                    await asyncio.to_thread(self._prune)
+                    pruned = time.monotonic()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error polling broadcast bus: {e}")
+            await asyncio.sleep(self.poll_interval)
+
+
+def get_backend() -> BroadcastBackend:
+    match config.BroadcastBackend:
+        case "local":
+            return LocalBackend()
+        case "sqlite":
+            return SQLiteBackend(
+                os.path.join(config.DataDir, "broadcast.db"),
+                poll_interval=config.BroadcastPollMs / 1000,
+                retention=config.BroadcastRetentionS,
+            )
+        case _:
+            raise ValueError(f"Unknown broadcast backend: {config.BroadcastBackend}")
@@ -1,60 +1,158 @@
 
+import re
 import uuid
 import time
+import json
+import asyncio
+import hashlib
+import mimetypes
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Callable, Optional
 from fastapi import HTTPException, status, APIRouter, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from urllib.parse import unquote
 from jose import jwt
 from sqlalchemy.exc import IntegrityError
 
-from obsync.utils import get_jwt_email
+from obsync.utils import get_jwt_email, token_cache
 from obsync.db import publish
 from obsync.db.models.publish import *
 from obsync.db.exceptions import *
 from obsync.schemas.publish import *
 from obsync.config import config
 from obsync.logger import logger
+from obsync.storage import blobstore, codecs
 
 
 publish_router = APIRouter(prefix="/publish", tags=["publish"])
 api_router = APIRouter(prefix="/api", tags=["api"])
 
+# Key of the site's Cache-Control policy in `Site.options`
+CACHE_CONTROL_OPTION = "cacheControl"
+SHA256_HEX = re.compile(r"[0-9a-fA-F]{64}")
+# Cache-Control directives a site may set, bare or with a number of seconds
+CACHE_DIRECTIVES = {
+    "public", "private", "no-cache", "no-store", "no-transform", "must-revalidate", "proxy-revalidate", "immutable",
+}
+CACHE_SECONDS_DIRECTIVES = {"max-age", "s-maxage", "stale-while-revalidate", "stale-if-error"}
+
+
+def _cache_headers(etag: str, mtime: int, options: dict) -> dict:
+    headers = {
+        "ETag": etag,
+        "Cache-Control": options.get(CACHE_CONTROL_OPTION) or config.PublishCacheControl,
+    }
+    if mtime:
+        headers["Last-Modified"] = formatdate(mtime / 1000, usegmt=True)
+    return headers
+
+
+def _parse_cache_control(value: str) -> Optional[str]:
+    """Normalizes a site's Cache-Control, or returns None if it has anything but known directives."""
+    directives = []
+    for directive in filter(None, (part.strip().lower() for part in value.split(","))):
+        name, has_value, seconds = directive.partition("=")
+        if name in CACHE_DIRECTIVES and not has_value:
+            directives.append(name)
+        elif name in CACHE_SECONDS_DIRECTIVES and seconds.isascii() and seconds.isdigit():
+            directives.append(f"{name}={int(seconds)}")
+        else:
+            return None
+    return ", ".join(directives)
+
+
+def _not_modified(request: Request, etag: str, mtime: int) -> bool:
+    """Evaluates If-None-Match, or If-Modified-Since when there is none (RFC 9110 13.2.2)."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None and mtime:
+        try:
+            return mtime // 1000 <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def _cached_response(
+    request: Request, build: Callable[[dict], Response], etag: str, mtime: int, options: dict
+) -> Response:
+    headers = _cache_headers(etag, mtime, options)
+    if _not_modified(request, etag, mtime):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return build(headers)
+
+
+def _content_type(path: str) -> str:
+    content_type = mimetypes.guess_type(path)[0]
+    if content_type is None:
+        # Notes and canvases are what gets published most; anything else unknown is opaque
+        extension = path.rsplit(".", 1)[-1].lower()
+        content_type = {"md": "text/markdown", "canvas": "application/json"}.get(
+            extension, "application/octet-stream"
+        )
+    # Starlette adds the charset to text/* types itself
+    if content_type == "application/json":
+        content_type += "; charset=utf-8"
+    return content_type
+
+
+def _file_response(file: publish.PublishedFile, path: str, headers: dict) -> Response:
+    media_type = _content_type(path)
+    if file.content is not None:
+        return Response(content=file.content, media_type=media_type, headers=headers)
+    # Opened here, before the response goes out, and held until the body is sent, so a page
+    # replaced meanwhile is still served whole
+    return StreamingResponse(
+        blobstore.stream(file.blob),
+        media_type=media_type,
+        headers={**headers, "Content-Length": str(file.size)},
+    )
+
 
 @api_router.post("/list")
 @publish_router.post("/list")
 async def list_sites( request: ListSitesRequest):
     email = get_jwt_email(request.token)
     if request.id == "":
-        sites = publish.get_sites(email)
+        sites = await publish.get_sites(email)
         return {
             "sites": sites,
             "shared": [],
             "limit": config.MaxSitesPerUser,
         }
-    siteOwner = publish.get_site_owner(request.id)
-    files = publish.get_files(request.id)
-    return {
-        "files": files,
+    siteOwner = await publish.get_site_owner(request.id)
+    # Stock clients send no limit and expect the whole site, so only page when asked to
+    limit = min(request.limit, config.PublishIndexPageSize) if request.limit and request.limit > 0 else None
+    files, more = await publish.get_files(request.id, request.prefix or "", request.after or "", limit)
+    response = {
+        "files": [dict(zip(publish.FILE_FIELDS, file)) for file in files],
         "owner": siteOwner == email,
     }
+    if limit is not None:
+        response["more"] = more
+    return response
 
 
 @publish_router.post("/create")
 async def create_site( request: CreateSiteRequest):
     email = get_jwt_email(request.token)
-    sites = publish.get_sites(email)
+    sites = await publish.get_sites(email)
     if len(sites) >= config.MaxSitesPerUser:
         raise HTTPException(status_code=status.HTTP_200_OK, detail=f"You have reached the limit of {config.MaxSitesPerUser} site")
-    site = publish.create_site(email)
+    site = await publish.create_site(email)
     return site
 
 
 @publish_router.post("/delete")
 async def delete_site( request: DeleteSiteRequest):
     email = get_jwt_email(request.token)
-    siteOwner = publish.get_site_owner(request.site_uid)
+    siteOwner = await publish.get_site_owner(request.site_uid)
     if email != siteOwner:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You do not have permission to delete this site")
-    publish.delete_site(request.site_uid)
+    await publish.delete_site(request.site_uid)
     return {}
 
 
@@ -64,18 +162,13 @@ async def get_slug_info( request: GetSlugInfoRequest):
     
     if len(request.ids) == 0: return {}
     
-    siteSlugs = {}
-    for id in request.ids:
-        slug = publish.get_site_slug(id)
-        siteSlugs[id] = slug
-        
-    return siteSlugs
+    return await publish.get_site_slugs([str(id) for id in request.ids])
 
 
 @api_router.post("/site")
 async def site_info(request: SiteInfoRequest):
     email = get_jwt_email(request.token)
-    site = publish.get_slug(request.slug)
+    site = await publish.get_slug(request.slug)
     if site is None:
         return {
             "code": "NOTFOUND",
@@ -88,10 +181,11 @@ async def site_info(request: SiteInfoRequest):
 @api_router.post("/remove")
 async def remove_file(request: RemoveFileRequest):
     email = get_jwt_email(request.token)
-    siteOwner = publish.get_site_owner(request.id)
+    site_id = request.id or request.site_uid
+    siteOwner = await publish.get_site_owner(site_id)
     if siteOwner != email:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You do not have permission to delete this file")
-    publish.remove_file(request.id, request.path)
+    await publish.remove_file(site_id, request.path)
     return {}
 
 
@@ -110,25 +204,40 @@ async def upload_file(request: Request):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-    site_owner= publish.get_site_owner(obs_id)
+    site_owner= await publish.get_site_owner(obs_id)
     if site_owner != email:
         raise HTTPException(status_code=403, detail="You do not have permission to upload to this site")
 
-    try:
-        data = await request.body()
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    declared = int(content_length) if content_length and content_length.isdigit() else None
+    if declared is not None and declared > config.PublishMaxBytes:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="File is too large")
 
+    writer = blobstore.BlobWriter()
+    try:
+        async for chunk in request.stream():
+            if writer.size + len(chunk) > config.PublishMaxBytes:
+                raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="File is too large")
+            writer.write(chunk)
+    except BaseException:
+        writer.abort()
+        raise
+    staged = writer.finish()
+
+    # The client's hash is the SHA-256 of the content, verified here while it was streamed in
+    if obs_hash and SHA256_HEX.fullmatch(obs_hash) and obs_hash.lower() != staged.hash:
+        blobstore.discard(staged)
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Content does not match obs-hash")
+
+    staged = await asyncio.to_thread(blobstore.compress, staged, codecs.choose(obs_path))
     file = PublishFile(
-        size=content_length,
-        hash=obs_hash,
+        size=staged.size,
+        hash=obs_hash or staged.hash,
         slug=obs_id,
         path=obs_path,
-        data=data.decode('utf-8')
     )
 
     try:
-        publish.new_file(file)
+        await publish.new_file(file, staged)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -138,39 +247,78 @@ async def upload_file(request: Request):
 @api_router.post("/slug")
 async def configure_site_slug(request: ConfigureSiteSlugRequest):
     email = get_jwt_email(request.token)
-    siteOwner = publish.get_site_owner(request.id)
+    siteOwner = await publish.get_site_owner(request.id)
     if email != siteOwner:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You do not have permission to change this site's slug")
-    publish.set_slug(request.slug, request.id)
+    await publish.set_slug(request.slug, request.id)
     return {}
 
 
-@publish_router.get("/{slug}")
-async def get_site_index(slug: str):
-    site = publish.get_slug(slug)
-    if site is None:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Site not found")
+@api_router.post("/cache")
+async def configure_site_cache(request: ConfigureSiteCacheRequest):
+    email = get_jwt_email(request.token)
+    siteOwner = await publish.get_site_owner(request.id)
+    if email != siteOwner:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You do not have permission to change this site's caching")
+    cache_control = _parse_cache_control(request.cache_control)
+    if cache_control is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Unsupported Cache-Control")
+    await publish.set_site_option(request.id, CACHE_CONTROL_OPTION, cache_control)
+    return {}
 
-    files = publish.get_files(site.id)
-    if files is None:
-        raise HTTPException(status_code=500, detail="Error retrieving files")
-    return files
-    
-    
-@publish_router.get("/{slug}/{path:path}")
-async def get_published_file(slug: str, path: str):
-    if path is None or path == '':
-        return await get_site_index(slug)
-    
-    site = publish.get_slug(slug)
+
+@api_router.get("/metrics")
+async def cache_metrics():
+    return {
+        "publish_cache": publish.page_cache.stats(),
+        "token_cache": token_cache.stats(),
+    }
+
+
+@publish_router.get("/{slug}")
+async def get_site_index(slug: str, request: Request, prefix: str = "", after: str = "", limit: int = 0):
+    """
+    Lists one page of a site's files as rows of `fields`. `next` is the `after` of the following
+    page, or null on the last one.
+    """
+    site = await publish.get_slug(slug)
     if site is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Site not found")
 
-    file = publish.get_file(site.id, path)
-    if file is None:
-        raise HTTPException(status_code=500, detail="File not found or error retrieving file")
-    
-    return file
+    limit = min(limit, config.PublishIndexPageSize) if limit > 0 else config.PublishIndexPageSize
+    # Tag the page by a cheap aggregate of the site, so revalidating never reads the listing
+    count, mtime, total = await publish.get_files_stamp(site.id)
+    stamp = json.dumps([count, mtime, total, prefix, after, limit, publish.FILE_FIELDS])
+    etag = '"' + hashlib.sha256(stamp.encode()).hexdigest() + '"'
+    headers = _cache_headers(etag, mtime, publish.site_options(site.options))
+    if _not_modified(request, etag, mtime):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    files, more = await publish.get_files(site.id, prefix, after, limit)
+    body = {
+        "fields": publish.FILE_FIELDS,
+        "files": files,
+        "next": files[-1][0] if more else None,
+    }
+    return JSONResponse(body, headers=headers)
 
 
-    
\ No newline at end of file
+@publish_router.get("/{slug}/{path:path}")
+async def get_published_file(slug: str, path: str, request: Request):
+    if path is None or path == '':
+        return await get_site_index(slug, request)
+
+    for retry in (False, True):
+        file = await publish.get_published_file(slug, path)
+        if file is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Site not found")
+        if file.hash is None:
+            raise HTTPException(status_code=500, detail="File not found or error retrieving file")
+        try:
+            return _cached_response(
+                request, lambda headers: _file_response(file, path, headers), f'"{file.hash}"', file.mtime, file.options
+            )
+        except FileNotFoundError:
+            # Replaced or removed since it was looked up; the next lookup sees what happened
+            if retry:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found")
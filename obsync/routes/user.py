@@ -5,7 +5,7 @@ from jose import jwt
 from sqlalchemy.exc import IntegrityError
 
 from obsync.schemas.user import *
-from obsync.utils import get_jwt_email, milisec
+from obsync.utils import get_jwt_email, milisec, token_cache
 from obsync.db import vault
 from obsync.db.models.vault import User
 from obsync.db.exceptions import *
@@ -37,7 +37,7 @@ async def signup(request: SignUpRequest):
         )
 
     try:
-        vault.new_user(request.email, request.password, request.name)
+        await vault.new_user(request.email, request.password, request.name)
         logger.info(f"Created new user: {request.email}-{request.name}")
     except IntegrityError as e:
         raise HTTPException(
@@ -61,7 +61,7 @@ async def signin(request: SigninRequest):
     - Appropriate HTTP error response with details in case of a failed authentication attempt or other errors.
     """
     try:
-        user_info = vault.login(request.email, request.password)
+        user_info = await vault.login(request.email, request.password)
     except SigninException as e:
         raise HTTPException(status_code=e.retcode, detail=e.message)
 
@@ -101,7 +101,7 @@ async def user_info(request: UserInfoRequest):
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Not logged in"
         )
 
-    user_info:User = vault.user_info(email)
+    user_info:User = await vault.user_info(email)
     if not user_info:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="User not found"
@@ -153,5 +153,6 @@ async def delete_user(request: UserInfoRequest):
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Not logged in"
         )
 
-    vault.delete_user(email)
+    await vault.delete_user(email)
+    token_cache.invalidate_email(email)
     return {}
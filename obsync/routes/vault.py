@@ -51,7 +51,7 @@ async def create_vault(request: CreateVaultRequest = Body(...)) -> VaultInfo:
             keyhash = request.keyhash
 
     try:
-        vault = crud_vault.new_vault(request.name, email, password, salt, keyhash)
+        vault = await crud_vault.new_vault(request.name, email, password, salt, keyhash)
         logger.info(f"Created new vault: {vault.id}-{vault.name}")
         return vault
     except Exception as e:
@@ -82,8 +82,8 @@ async def list_vaults(
         )
 
     try:
-        vaults: List[VaultInfo] = crud_vault.get_vaults(email)
-        shared_vaults: List[VaultInfo] = crud_vault.get_shared_vaults(email)
+        vaults: List[VaultInfo] = await crud_vault.get_vaults(email)
+        shared_vaults: List[VaultInfo] = await crud_vault.get_shared_vaults(email)
         return {"shared": shared_vaults, "vaults": vaults}
     except Exception as e:
         raise HTTPException(
@@ -113,20 +113,20 @@ async def access_vault(request: AccessVaultRequest = Body(...)):
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Unauthorized"
         )
 
-    if not crud_vault.has_access_to_vault(request.vault_uid, email):
+    if not await crud_vault.has_access_to_vault(request.vault_uid, email):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="You do not have access to this vault",
         )
 
     try:
-        vault_data = crud_vault.get_vault(request.vault_uid, request.keyhash)
+        vault_data = await crud_vault.get_vault(request.vault_uid, request.keyhash)
         if vault_data is None:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND, detail="Vault not found"
             )
 
-        user = crud_vault.user_info(email)
+        user = await crud_vault.user_info(email)
         if user is None:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND, detail="User not found"
@@ -168,7 +168,7 @@ async def delete_vault(request: DeleteVaultRequest = Body(...)) -> Dict:
         )
 
     try:
-        crud_vault.delete_vault(request.vault_uid, email)
+        await crud_vault.delete_vault(request.vault_uid, email)
         logger.info(f"Deleted vault: {request.vault_uid}")
         return {"status": "ok"}
     except Exception as e:
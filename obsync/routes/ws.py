@@ -1,12 +1,21 @@
 import json
-from fastapi import WebSocket, APIRouter
-from typing import Dict, Any, List
+import math
+import asyncio
+from collections import deque
+from fastapi import WebSocket, APIRouter, status
+from typing import Dict, Any, Awaitable, Callable, List, Optional
 from pydantic import BaseModel
 from starlette.websockets import WebSocketDisconnect
 
 from obsync.db import vault, vaultfiles
+from obsync.db.exceptions import StorageLimitExceeded
 from obsync.db.models import Vault
 from obsync.utils import *
+from obsync.storage import blobstore, codecs
+from obsync.storage import delta
+from obsync.storage.delta import DeltaError
+from obsync.pubsub import get_backend
+from obsync.storage.blobstore import StagedBlob
 from obsync.schemas.vaultfiles import (
     FileInfo,
     WSHandlerPushModel,
@@ -16,23 +25,301 @@ from obsync.schemas.vaultfiles import (
 )
 
 
+LISTING_BATCH_SIZE = 500
+# Broadcasts a client may fall behind by before it is dropped and left to resync on reconnect
+SEND_QUEUE_SIZE = 1024
+# Bytes of its own replies (pieces included) a connection may have in flight before it waits
+SEND_BUFFER_BYTES = 8 * 1048576
+# Requests a connection may have running at once before its frames are no longer read
+MAX_IN_FLIGHT = 32
+# Pieces of a push buffered ahead of its handler before the connection's frames are no longer read
+UPLOAD_QUEUE_PIECES = 4
+
+
+class Client:
+    """
+    Owns all writes to one websocket. Outgoing messages go through a queue drained by a
+    dedicated writer task, so a slow or half-dead device only ever delays itself.
+    """
+
+    def __init__(self, ws: WebSocket):
+        self.ws = ws
+        self.closed = False
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._pending = 0
+        self._buffered = 0
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self._writer = asyncio.create_task(self._write())
+
+    async def _write(self):
+        try:
+            while True:
+                message = await self._queue.get()
+                if message is None:
+                    return
+                if isinstance(message, str):
+                    await self.ws.send_text(message)
+                else:
+                    await self.ws.send_bytes(message)
+                self._pending -= 1
+                self._buffered -= len(message)
+                if self._buffered < SEND_BUFFER_BYTES:
+                    self._drained.set()
+        except Exception:
+            pass  # NOTE: client has disconnected, the receive loop will notice
+        finally:
+            self.closed = True
+            self._drained.set()
+
+    def _put(self, message: str | bytes) -> None:
+        self._pending += 1
+        self._buffered += len(message)
+        if self._buffered >= SEND_BUFFER_BYTES:
+            self._drained.clear()
+        self._queue.put_nowait(message)
+
+    async def send(self, message: str | bytes) -> None:
+        """Queues a reply, waiting while too many reply bytes are still unsent."""
+        await self._drained.wait()
+        if self.closed:
+            raise WebSocketDisconnect()
+        self._put(message)
+
+    async def send_text(self, data: str) -> None:
+        await self.send(data)
+
+    async def send_bytes(self, data: bytes) -> None:
+        await self.send(data)
+
+    async def send_json(self, data: Any) -> None:
+        await self.send(json.dumps(data))
+
+    def offer(self, message: str) -> bool:
+        """Queues a broadcast without waiting. Returns False if the client has fallen too far behind."""
+        if self.closed or self._pending >= SEND_QUEUE_SIZE:
+            return False
+        self._put(message)
+        return True
+
+    async def receive_text(self) -> str:
+        return await self.ws.receive_text()
+
+    async def receive(self) -> str | bytes:
+        """Returns the next frame, text or binary."""
+        message = await self.ws.receive()
+        if message["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(message.get("code", status.WS_1000_NORMAL_CLOSURE))
+        if message.get("text") is not None:
+            return message["text"]
+        return message.get("bytes") or b""
+
+    async def receive_bytes(self) -> bytes:
+        return await self.ws.receive_bytes()
+
+    async def close(self, timeout: float = 5) -> None:
+        """Flushes queued messages, then stops the writer."""
+        if self.closed:
+            self._writer.cancel()
+            return
+        self._queue.put_nowait(None)
+        try:
+            await asyncio.wait_for(self._writer, timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def abort(self) -> None:
+        """Drops the connection without flushing; the device resyncs from its version on reconnect."""
+        self.closed = True
+        self._writer.cancel()
+        asyncio.ensure_future(self._close_socket())
+
+    async def _close_socket(self):
+        try:
+            await self.ws.close(code=status.WS_1013_TRY_AGAIN_LATER)
+        except RuntimeError:  # NOTE: client has already disconnected
+            pass
+
+
 class ChannelManager:
-    def __init__(self, clients: Dict[WebSocket, bool]):
+    def __init__(self, vault_id: str, clients: Dict[Client, bool]):
+        self.vault_id = vault_id
         self.clients = clients
 
-    def add_client(self, websocket: WebSocket):
-        self.clients[websocket] = True
+    def add_client(self, client: Client):
+        self.clients[client] = True
 
-    def remove_client(self, websocket: WebSocket):
-        if websocket in self.clients:
-            del self.clients[websocket]
+    def remove_client(self, client: Client):
+        if client in self.clients:
+            del self.clients[client]
 
     def is_empty(self):
         return len(self.clients) == 0
 
     async def broadcast(self, data: Dict[str, Any]):
-        for client in self.clients:
-            await client.send_json(data)
+        # Serialize once; the backend hands the same text to every process serving this vault
+        await broadcaster.publish(self.vault_id, json.dumps(data))
+
+    def deliver(self, message: str):
+        # Queue for every local client without waiting on any socket
+        for client in list(self.clients):
+            if not client.offer(message):
+                logger.warning("Dropping client whose send queue overflowed")
+                self.remove_client(client)
+                client.abort()
+
+
+class Upload:
+    """The binary frames a push is still owed, and the bounded queue they are handed over in."""
+
+    def __init__(self, pieces: int):
+        self.queue: Optional[asyncio.Queue] = asyncio.Queue(UPLOAD_QUEUE_PIECES)
+        self.remaining = pieces
+
+
+class Request:
+    """
+    One message being handled. Replies to a tagged message carry its tag, and the binary
+    pieces of a push arrive through the dispatcher rather than straight from the socket.
+    """
+
+    def __init__(self, dispatcher: "Dispatcher", tag: Any = None):
+        self.dispatcher = dispatcher
+        self.tag = tag
+        self._upload: Optional[Upload] = None
+
+    @property
+    def tagged(self) -> bool:
+        return self.tag is not None
+
+    @property
+    def binary(self) -> asyncio.Lock:
+        """Held while sending binary frames, which cannot be tagged and so must not interleave."""
+        return self.dispatcher.binary
+
+    def expect_pieces(self, pieces: int) -> None:
+        if self._upload is None and pieces > 0:
+            self._upload = self.dispatcher.expect(pieces)
+
+    async def send_json(self, data: Dict[str, Any]) -> None:
+        if self.tagged:
+            data = {**data, "tag": self.tag}
+        await self.dispatcher.ws.send_json(data)
+
+    async def send_bytes(self, data: bytes) -> None:
+        await self.dispatcher.ws.send_bytes(data)
+
+    async def receive_bytes(self) -> bytes:
+        return await self._upload.queue.get()
+
+    def finish(self) -> None:
+        if self._upload is not None:
+            self.dispatcher.forget(self._upload, drain=self.tagged)
+            self._upload = None
+
+
+class Dispatcher:
+    """
+    Reads every frame of a connection and runs the messages in them.
+
+    Messages without a `tag`, which is all stock clients send, are handled one after another
+    as before. Tagged messages run concurrently, each waiting only for earlier tagged messages
+    on the same path, and their replies carry the tag. Binary frames go to pushes in the order
+    the pushes arrived; a tagged push sends its pieces right behind the message instead of
+    waiting for {"res": "next"} before each one.
+    """
+
+    UNTAGGED = object()
+
+    def __init__(self, ws: Client, handler: Callable[[Request, Dict[str, Any]], Awaitable[None]]):
+        self.ws = ws
+        self.binary = asyncio.Lock()
+        self._handler = handler
+        self._uploads: deque = deque()
+        self._lanes: Dict[Any, asyncio.Task] = {}
+        self._tasks: set = set()
+        self._slots = asyncio.Semaphore(MAX_IN_FLIGHT)
+        self._failed: Optional[asyncio.Future] = None
+
+    def expect(self, pieces: int) -> Upload:
+        upload = Upload(pieces)
+        self._uploads.append(upload)
+        return upload
+
+    def forget(self, upload: Upload, drain: bool) -> None:
+        """
+        Stops routing pieces to a push that has finished or failed. A tagged push was sent its
+        pieces unasked, so the ones still owed are dropped as they arrive; an untagged push only
+        gets the pieces it asked for, so it simply leaves the line.
+        """
+        queue, upload.queue = upload.queue, None
+        while queue is not None and not queue.empty():
+            queue.get_nowait()  # NOTE: also wakes a reader blocked on the full queue
+        if not drain and upload.remaining > 0:
+            self._uploads.remove(upload)
+
+    async def _route(self, data: bytes) -> None:
+        if not self._uploads:
+            logger.warning("Dropping a binary frame no push is waiting for")
+            return
+        upload = self._uploads[0]
+        upload.remaining -= 1
+        if upload.remaining <= 0:
+            self._uploads.popleft()
+        if upload.queue is not None:
+            # Blocks the reader while the push is behind, so its pieces wait in the socket instead
+            await upload.queue.put(data)
+
+    async def _handle(self, request: Request, msg: Dict[str, Any], previous: Optional[asyncio.Task]):
+        try:
+            if previous is not None:
+                await asyncio.wait({previous})
+            await self._handler(request, msg)
+        except Exception as e:
+            if not self._failed.done():
+                self._failed.set_exception(e)
+        finally:
+            request.finish()
+            self._slots.release()
+
+    def _dispatch(self, msg: Dict[str, Any]) -> None:
+        request = Request(self, msg.get("tag"))
+        if request.tagged:
+            lane = msg.get("path") or None
+            if msg.get("op") == "push" and (msg.get("size") or 0) > 0 and msg.get("pieces"):
+                # Register now, so the pieces that follow this message are routed to it
+                request.expect_pieces(to_int(msg["pieces"]))
+        else:
+            lane = self.UNTAGGED
+
+        previous = self._lanes.get(lane) if lane is not None else None
+        task = asyncio.create_task(self._handle(request, msg, previous))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        if lane is not None:
+            self._lanes[lane] = task
+            task.add_done_callback(lambda t: self._lanes.get(lane) is t and self._lanes.pop(lane))
+
+    async def _read(self) -> None:
+        while True:
+            frame = await self.ws.receive()
+            if isinstance(frame, bytes):
+                await self._route(frame)
+                continue
+            await self._slots.acquire()
+            self._dispatch(json.loads(frame))
+
+    async def run(self) -> None:
+        """Serves the connection until it closes or a handler fails, and re-raises why."""
+        self._failed = asyncio.get_running_loop().create_future()
+        reader = asyncio.create_task(self._read())
+        try:
+            done, _ = await asyncio.wait({reader, self._failed}, return_when=asyncio.FIRST_COMPLETED)
+            done.pop().result()
+        finally:
+            reader.cancel()
+            for task in list(self._tasks):
+                task.cancel()
 
 
 class InitializationRequest(BaseModel):
@@ -46,18 +333,153 @@ class InitializationRequest(BaseModel):
 
 
 
+async def receive_pieces(ws: Request, pieces: int, limit: int) -> Optional[StagedBlob]:
+    """
+    Streams the binary pieces of an upload into a staged blob, one piece in memory at a time.
+    Untagged pushes ask for each piece; tagged ones already have theirs on the way.
+    Replies with an error and returns None once the pieces add up to more than `limit` bytes.
+    """
+    ws.expect_pieces(pieces)
+    writer = blobstore.BlobWriter()
+    try:
+        for _ in range(pieces):
+            if not ws.tagged:
+                await ws.send_json({"res": "next"})
+            piece = await ws.receive_bytes()
+            if writer.size + len(piece) > limit:
+                writer.abort()
+                await ws.send_json({"error": "upload larger than announced"})
+                return None
+            writer.write(piece)
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.finish()
+
+
+async def apply_delta(
+    ws: Request, vault_id: str, metadata: WSHandlerPushModel, staged: StagedBlob
+) -> Optional[StagedBlob]:
+    """
+    Rebuilds a delta push against the stored revision it names. Replies with an error and
+    returns None when the base is unknown or the result does not match the announced size,
+    so the client can fall back to a full push.
+    """
+    base = await vaultfiles.get_revision_blob(vault_id, metadata.path, metadata.delta_base)
+    if base is None:
+        blobstore.discard(staged)
+        await ws.send_json({"error": "unknown delta base"})
+        return None
+    try:
+        staged = await asyncio.to_thread(blobstore.rebuild, base, staged, metadata.size)
+    except DeltaError as e:
+        await ws.send_json({"error": f"invalid delta: {e}"})
+        return None
+    if staged.size != metadata.size:
+        blobstore.discard(staged)
+        await ws.send_json({"error": "invalid delta: size mismatch"})
+        return None
+    return staged
+
+
+async def send_pieces(ws: Request, file: FileInfo) -> None:
+    """
+    Streams stored content as fixed-size pieces. Pieces are read and decoded one at a time on
+    a worker thread, so a pull holds about one piece in memory and never blocks the loop.
+    """
+    if file.blob is not None:
+        try:
+            # Opened up front, so a release from here on cannot pull the content from under us
+            content = await asyncio.to_thread(blobstore.pieces, file.blob, config.PieceSize)
+        except FileNotFoundError:
+            # Released between looking the revision up and opening it
+            await ws.send_json({"error": "file not found"})
+            return
+    else:
+        data = file.data or b""
+        content = (data[i : i + config.PieceSize] for i in range(0, len(data), config.PieceSize))
+    try:
+        async with ws.binary:
+            pieces = math.ceil(file.size / config.PieceSize)
+            await ws.send_json({"hash": file.hash, "size": file.size, "pieces": pieces})
+            while (piece := await asyncio.to_thread(next, content, None)) is not None:
+                await ws.send_bytes(piece)
+    finally:
+        try:
+            content.close()
+        except ValueError:
+            pass  # NOTE: still running on its thread after a disconnect, its files close when collected
+
+
+async def send_changes(ws: Client, vault_id: str, since: int) -> None:
+    """
+    Streams files changed since `since` as `push` messages, one page of metadata at a time.
+    The next page is fetched while the current one is written, and each write waits for the
+    transport, so a slow client holds back the producer instead of growing a buffer.
+    """
+    page = await vaultfiles.get_vault_files(vault_id, since, 0, LISTING_BATCH_SIZE)
+    while page:
+        next_page = None
+        if len(page) == LISTING_BATCH_SIZE:
+            next_page = asyncio.ensure_future(
+                vaultfiles.get_vault_files(vault_id, since, page[-1].uid, LISTING_BATCH_SIZE)
+            )
+        try:
+            messages = [
+                json.dumps(
+                    {
+                        "op": "push",
+                        "path": file.path,
+                        "hash": file.hash,
+                        "size": file.size,
+                        "ctime": file.created,
+                        "mtime": file.modified,
+                        "folder": file.folder,
+                        "deleted": file.deleted,
+                        "device": "insignificantv5",
+                        "uid": file.uid,
+                    }
+                )
+                for file in page
+            ]
+            for message in messages:
+                await ws.send_text(message)
+        except BaseException:
+            if next_page is not None:
+                next_page.cancel()
+            raise
+        page = await next_page if next_page is not None else []
+
+
+async def send_deleted(ws: Request, vault_id: str) -> None:
+    """
+    Lists the vault's deleted files one page at a time. Tagged requests get a message per page
+    with `more` set until the last; stock clients get a single message, assembled page by page.
+    """
+    items, after = [], 0
+    while True:
+        page = await vaultfiles.get_deleted_files(vault_id, after, LISTING_BATCH_SIZE)
+        more = len(page) == LISTING_BATCH_SIZE
+        if ws.tagged:
+            await ws.send_json({"items": page, "more": more})
+        else:
+            items.extend(page)
+        if not more:
+            break
+        after = page[-1]["uid"]
+    if not ws.tagged:
+        await ws.send_json({"items": items})
+
+
 async def handle_message(
-    ws: WebSocket,
-    msg: str,
+    ws: Request,
+    msg: Dict[str, Any],
     connectedVault: vault.Vault,
-    version: int,
     channels: Dict[str, ChannelManager],
-    version_bumped,
 ):
-    msg = json.loads(msg)
     match msg["op"]:
         case "size":
-            size = vaultfiles.get_vault_size(connectedVault.id)
+            size = await vaultfiles.get_vault_size(connectedVault.id)
             await ws.send_json(
                 {"res": "ok", "size": size, "limit": config.MaxStorageBytes}
             )
@@ -65,61 +487,86 @@ async def handle_message(
         case "pull":
             pull = WSHandlerPullModel(**msg)
             uid: int = utils.to_int(pull.uid)
-            file = vaultfiles.get_file(uid) # type: ignore
-            pieces = 0 if file.size == 0 else 1
-            await ws.send_json({"hash": file.hash, "size": file.size, "pieces": pieces})
-            if file.size != 0:
-                await ws.send_bytes(file.data)
+            file = await vaultfiles.get_file(uid) # type: ignore
+            if file.size == 0:
+                await ws.send_json({"hash": file.hash, "size": file.size, "pieces": 0})
+            else:
+                await send_pieces(ws, file)
 
         case "push":
             metadata = WSHandlerPushModel(**msg)
-            if metadata.deleted:
-                vaultfiles.delete_vault_file(metadata.path) # type: ignore
-                vaultUID = metadata.uid
-            else:
-                vaultUID = vaultfiles.insert_metadata(
-                    vaultfiles.File(
-                        vault_id=connectedVault.id,
-                        path=metadata.path,
-                        extension=metadata.extension,
-                        hash=metadata.hash,
-                        size=metadata.size,
-                        created=metadata.ctime,
-                        modified=metadata.mtime,
-                        folder=metadata.folder,
-                        deleted=metadata.deleted,
-                    )
-                ) # type: ignore
-            if metadata.size is not None and metadata.size > 0:
-                full_binary = b""
-                for _ in range(metadata.pieces):
-                    await ws.send_json({"res": "next"})
-                    full_binary += await ws.receive_bytes()
-                vaultfiles.insert_data(vaultUID, full_binary)
+            staged = None
+            # Whatever is still staged when this ends without storing it, on a refusal or a
+            # disconnect cancelling the handler, is dropped rather than left in the temp dir
+            try:
+                if metadata.size is not None and metadata.size > 0:
+                    if not metadata.deleted:
+                        used = await vaultfiles.get_vault_size(connectedVault.id)
+                        if used + metadata.size > config.MaxStorageBytes:
+                            # Refuse before asking for any piece
+                            await ws.send_json({"error": "vault storage limit exceeded"})
+                            return
+                    limit = metadata.size if metadata.delta_base is None else delta.bound(metadata.size)
+                    staged = await receive_pieces(ws, metadata.pieces, limit)
+                    if staged is None:
+                        return
+                    if not metadata.deleted:
+                        if metadata.delta_base is not None:
+                            staged = await apply_delta(ws, connectedVault.id, metadata, staged)
+                            if staged is None:
+                                return
+                        staged = await asyncio.to_thread(
+                            blobstore.compress, staged, codecs.choose(metadata.extension or metadata.path)
+                        )
+                if metadata.deleted:
+                    await vaultfiles.delete_vault_file(connectedVault.id, metadata.path) # type: ignore
+                    vaultUID = metadata.uid
+                else:
+                    if staged is not None:
+                        metadata.size = staged.size
+                    try:
+                        vaultUID = await vaultfiles.insert_metadata(
+                            vaultfiles.File(
+                                vault_id=connectedVault.id,
+                                path=metadata.path,
+                                extension=metadata.extension,
+                                hash=metadata.hash,
+                                size=metadata.size,
+                                created=metadata.ctime,
+                                modified=metadata.mtime,
+                                folder=metadata.folder,
+                                deleted=metadata.deleted,
+                            ),
+                            staged,
+                            config.MaxStorageBytes,
+                        ) # type: ignore
+                    except StorageLimitExceeded:
+                        await ws.send_json({"error": "vault storage limit exceeded"})
+                        return
+            finally:
+                if staged is not None:
+                    blobstore.discard(staged)
             metadata.uid = vaultUID
-            await channels[connectedVault.id].broadcast(metadata.model_dump())
-            if not version_bumped:
-                vault.set_vault_version(connectedVault.id, version + 1)
-                version_bumped = True
+            await channels[connectedVault.id].broadcast(metadata.model_dump(exclude={"delta_base"}))
             await ws.send_json({"op": "ok"})
 
         case "history":
             history = WSHandlerHistoryModel(**msg)
-            files = vaultfiles.get_file_history(history.path) # type: ignore
-            files = [file.model_dump() for file in files]
-            await ws.send_json({"items": files, "more": False})
+            files, more = await vaultfiles.get_file_history(
+                connectedVault.id, history.path, utils.to_int(history.last), config.HistoryPageSize
+            ) # type: ignore
+            await ws.send_json({"items": [file.model_dump() for file in files], "more": more})
 
         case "ping":
             await ws.send_json({"op": "pong"})
 
         case "deleted":
-            files = vaultfiles.get_deleted_files() # type: ignore
-            await ws.send_json({"items": files})
+            await send_deleted(ws, connectedVault.id)
 
         case "restore":
             restore = WSHandlerRestoreModel(**msg)
             uid: int = utils.to_int(restore.uid)
-            file = vaultfiles.restore_file(uid) # type: ignore
+            file = await vaultfiles.restore_file(uid) # type: ignore
             await channels[connectedVault.id].broadcast(file.model_dump())
             await ws.send_json({"res": "ok"})
 
@@ -130,23 +577,33 @@ async def handle_message(
 
 ws_router = APIRouter(tags=["ws"])
 channels: Dict[str, ChannelManager] = {}
+broadcaster = get_backend()
+
+
+def deliver(vault_id: str, message: str):
+    channel = channels.get(vault_id)
+    if channel is not None:
+        channel.deliver(message)
+
 
 @ws_router.websocket("/")
 @ws_router.websocket("/ws")
 @ws_router.websocket("/ws.obsidian.md")
-async def websocket_endpoint(ws: WebSocket):
-    await ws.accept()
+async def websocket_endpoint(websocket: WebSocket):
+    await websocket.accept()
+    ws = Client(websocket)
+    channel = None
     try:
         msg: Dict = await ws.receive_text()
         connectionInfo = InitializationRequest(**json.loads(msg))
         # Validate token and key hash
         email = get_jwt_email(connectionInfo.token)
 
-        connectedVault:Vault = vault.get_vault(connectionInfo.id, connectionInfo.keyhash) # type: ignore
+        connectedVault:Vault = await vault.get_vault(connectionInfo.id, connectionInfo.keyhash) # type: ignore
 
         logger.info(f"{email} - {connectionInfo.device} connected")
 
-        if not vault.has_access_to_vault(connectedVault.id, email): # type: ignore
+        if not await vault.has_access_to_vault(connectedVault.id, email): # type: ignore
             await ws.send_json({"error": "no access to vault"})
             logger.info(
                 f"{email} - {connectionInfo.device} has no access to vault {connectedVault.id}"
@@ -157,60 +614,42 @@ async def websocket_endpoint(ws: WebSocket):
         version = to_int(connectionInfo.version)
 
         if connectedVault.version > version:
-            files:List[FileInfo] = vaultfiles.get_vault_files(connectedVault.id) # type: ignore
-            for file in files:
-                await ws.send_json(
-                    {
-                        "op": "push",
-                        "path": file.path,
-                        "hash": file.hash,
-                        "size": file.size,
-                        "ctime": file.created,
-                        "mtime": file.modified,
-                        "folder": file.folder,
-                        "deleted": file.deleted,
-                        "device": "insignificantv5",
-                        "uid": file.uid,
-                    }
-                )
+            await send_changes(ws, connectedVault.id, version)
 
-        version_bumped = False
         await ws.send_json({"op": "ready", "version": connectedVault.version})
 
-        vaultfiles.snap_shot(connectedVault.id)
-
         if connectedVault.version < version:
-            vault.set_vault_version(connectedVault.id, version)
+            await vault.set_vault_version(connectedVault.id, version)
 
+        await broadcaster.start(deliver)
         if connectedVault.id not in channels:
-            channels[connectedVault.id] = ChannelManager(
-                clients={}
-            )  # TODO: clients: make(map[*ws.Conn]bool),
+            channels[connectedVault.id] = ChannelManager(connectedVault.id, clients={})
 
         channel = channels[connectedVault.id]
         channel.add_client(ws)
 
         try:
-            while True:
-                msg: Dict = await ws.receive_text()
-                await handle_message(
-                    ws, msg, connectedVault, version, channels, version_bumped
-                )
+            await Dispatcher(
+                ws, lambda request, msg: handle_message(request, msg, connectedVault, channels)
+            ).run()
         except WebSocketDisconnect:
             logger.info("WebSocket disconnected")
-
-            channel.remove_client(ws)
-            if channel.is_empty():
-                del channels[connectedVault.id]
         except Exception as e:
             logger.error(e)
             logger.error(e.__traceback__)
             await ws.send_json({"error": str(e)})
             await ws.send_json({"error": str(e.__traceback__)})
+    except WebSocketDisconnect:
+        pass
     except Exception as e:
         await ws.send_json({"error": str(e)})
     finally:
+        if channel is not None:
+            channel.remove_client(ws)
+            if channel.is_empty() and channels.get(connectedVault.id) is channel:
+                del channels[connectedVault.id]
+        await ws.close()
         try:
-            await ws.close()
+            await websocket.close()
         except RuntimeError:  # NOTE: client has already disconnected
             pass
@@ -8,6 +8,10 @@ class ListSitesRequest(BaseModel):
     token: str
     version: Optional[int] = 0
     id: Optional[str] = ""
+    # Paging through a site's files; without a limit the whole site is listed
+    prefix: Optional[str] = ""
+    after: Optional[str] = ""
+    limit: Optional[int] = 0
     
 
 class CreateSiteRequest(BaseModel):
@@ -25,6 +29,13 @@ class ConfigureSiteSlugRequest(BaseModel):
     slug: str
     
 
+class ConfigureSiteCacheRequest(BaseModel):
+    token: str
+    id: str
+    # Cache-Control sent with the site's pages; empty restores the server default
+    cache_control: str = ""
+
+
 class GetSlugInfoRequest(BaseModel):
     token: str
     ids: list
@@ -37,7 +48,8 @@ class SiteInfoRequest(BaseModel):
     
 class RemoveFileRequest(BaseModel):
     token: str
-    site_uid: str
+    id: Optional[str] = ""
+    site_uid: Optional[str] = ""
     path: str
     
     
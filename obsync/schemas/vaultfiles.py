@@ -14,6 +14,7 @@ class FileInfo(BaseModel):
     folder: Optional[bool] = False
     deleted: Optional[bool] = False
     data: Optional[bytes] = None
+    blob: Optional[str] = None
     newest: Optional[bool] = False
     is_snapshot: Optional[bool] = False
 
@@ -42,6 +43,8 @@ class WSHandlerPushModel(BaseModel):
     deleted: Optional[bool] = False
     size: Optional[int] = 0
     pieces: Optional[int] = 0
+    # Client hash of an earlier revision of `path`; when set the pieces carry a delta against it
+    delta_base: Optional[str] = None
 
 
 class WSHandlerHistoryModel(BaseModel):
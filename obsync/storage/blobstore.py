@@ -0,0 +1,365 @@
+import os
+import time
+import uuid
+import hashlib
+from contextlib import contextmanager
+from pathlib import Path
+from typing import BinaryIO, Iterator, List, NamedTuple, Optional, Tuple
+
+from obsync.config import config
+from . import codecs, delta
+
+
+BlobDir = os.path.join(config.DataDir, "blobs")
+TmpDir = os.path.join(BlobDir, "tmp")
+
+
+# Digests are hex SHA-256, which is also the header of a stored delta naming its base
+KEY_LENGTH = 64
+# Compressed blobs start with their uncompressed size as a big-endian u64
+SIZE_HEADER = 8
+SUFFIXES = {codecs.ZLIB: ".zz", codecs.ZSTD: ".zst"}
+# Kind of a stored blob file holding a delta, alongside the codecs
+DELTA = "delta"
+COPY_SIZE = 1048576
+# Temp files untouched for this long belong to no upload still in progress
+STALE_TMP_S = 3600
+
+
+class StagedBlob(NamedTuple):
+    """
+    Content written to a temp file and not yet placed into the store. When `base` is set
+    the file holds a delta against that blob, when `codec` is set it holds the compressed
+    content; `hash` and `size` always describe the content itself.
+    """
+
+    path: str
+    hash: str
+    size: int
+    base: Optional[str] = None
+    codec: str = codecs.NONE
+
+
+def blob_path(key: str) -> str:
+    # Shard by the first two bytes of the digest: blobs/ab/cd/abcd...
+    return os.path.join(BlobDir, key[:2], key[2:4], key)
+
+
+def delta_path(key: str) -> str:
+    return blob_path(key) + ".delta"
+
+
+def compressed_path(key: str, codec: str) -> str:
+    return blob_path(key) + SUFFIXES[codec]
+
+
+def _paths(key: str) -> list:
+    return [blob_path(key), delta_path(key)] + [compressed_path(key, codec) for codec in SUFFIXES]
+
+
+def exists(key: str) -> bool:
+    return any(os.path.exists(path) for path in _paths(key))
+
+
+def _tmp_path() -> str:
+    Path(TmpDir).mkdir(parents=True, exist_ok=True)
+    return os.path.join(TmpDir, f"{uuid.uuid4().hex}.tmp")
+
+
+def sweep_tmp(max_age: float = STALE_TMP_S) -> int:
+    """
+    Removes temp files left behind by a crash, or by a step whose handler was cancelled
+    while it ran in a thread. Returns the number removed.
+    """
+    removed, cutoff = 0, time.time() - max_age
+    try:
+        entries = list(os.scandir(TmpDir))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+                removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+class BlobWriter:
+    """Streams content into a temp file, hashing it incrementally."""
+
+    def __init__(self):
+        self.path = _tmp_path()
+        self.size = 0
+        self._hash = hashlib.sha256()
+        self._file = open(self.path, "wb")
+
+    def write(self, data: bytes) -> None:
+        self._file.write(data)
+        self._hash.update(data)
+        self.size += len(data)
+
+    def finish(self) -> StagedBlob:
+        self._file.close()
+        return StagedBlob(self.path, self._hash.hexdigest(), self.size)
+
+    def abort(self) -> None:
+        self._file.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def stage(data: bytes) -> StagedBlob:
+    writer = BlobWriter()
+    writer.write(data)
+    return writer.finish()
+
+
+def rebuild(base: str, staged_delta: StagedBlob, limit: Optional[int] = None) -> StagedBlob:
+    """
+    Applies an uploaded delta to the stored `base` blob. Returns the result staged as a delta
+    container (base key + delta), hashed and sized as the reconstructed content, which is
+    streamed through rather than built in memory. Raises DeltaError if the content would
+    grow past `limit` bytes.
+    """
+    digest, size = hashlib.sha256(), 0
+    path = _tmp_path()
+    try:
+        with open(staged_delta.path, "rb") as patch, open(path, "wb") as out:
+            out.write(base.encode())
+            while data := patch.read(COPY_SIZE):
+                out.write(data)
+            patch.seek(0)
+            files = _open(base)
+            try:
+                with _seekable(files, COPY_SIZE) as source:
+                    for data in delta.apply_stream(source, patch, COPY_SIZE):
+                        size += len(data)
+                        if limit is not None and size > limit:
+                            raise delta.DeltaError("Content larger than announced")
+                        digest.update(data)
+            finally:
+                _close(files)
+    except BaseException:
+        discard(StagedBlob(path, "", 0))
+        raise
+    finally:
+        discard(staged_delta)
+    return StagedBlob(path, digest.hexdigest(), size, base)
+
+
+def materialize(staged: StagedBlob) -> StagedBlob:
+    """Turns a staged delta into staged full content, for storing a keyframe."""
+    if staged.base is None:
+        return staged
+    writer = BlobWriter()
+    try:
+        with open(staged.path, "rb") as f:
+            f.seek(KEY_LENGTH)
+            files = _open(staged.base)
+            try:
+                for data in _decode([(f, DELTA)] + files, COPY_SIZE):
+                    writer.write(data)
+            finally:
+                _close(files)
+    except BaseException:
+        writer.abort()
+        raise
+    finally:
+        discard(staged)
+    return writer.finish()
+
+
+def _compress_file(src_path: str, key: str, size: int, codec: str) -> Optional[StagedBlob]:
+    with open(src_path, "rb") as src:
+        if not codecs.worthwhile(codec, src.read(codecs.SAMPLE_SIZE)):
+            return None
+        src.seek(0)
+        path = _tmp_path()
+        compressor = codecs.compressor(codec)
+        with open(path, "wb") as dst:
+            dst.write(size.to_bytes(SIZE_HEADER, "big"))
+            while data := src.read(COPY_SIZE):
+                dst.write(compressor.compress(data))
+            dst.write(compressor.flush())
+            compressed_size = dst.tell()
+    staged = StagedBlob(path, key, size, codec=codec)
+    if compressed_size >= size:
+        discard(staged)
+        return None
+    return staged
+
+
+def compress(staged: StagedBlob, codec: str) -> StagedBlob:
+    """
+    Compresses staged content with `codec`, keeping the original when compression does not
+    pay off. Deltas are left alone, they are small already.
+    """
+    if codec == codecs.NONE or staged.base is not None or staged.codec != codecs.NONE:
+        return staged
+    result = _compress_file(staged.path, staged.hash, staged.size, codec)
+    if result is None:
+        return staged
+    discard(staged)
+    return result
+
+
+def recompress(key: str, size: int, codec: str) -> Optional[StagedBlob]:
+    """Stages a compressed copy of a stored uncompressed blob, or returns None if it does not pay off."""
+    if codec == codecs.NONE or not os.path.exists(blob_path(key)):
+        return None
+    return _compress_file(blob_path(key), key, size, codec)
+
+
+def swap(staged: StagedBlob) -> None:
+    """
+    Replaces a stored uncompressed blob with its compressed copy from `recompress`.
+    The compressed file is in place before the original goes, so readers always find one.
+    Callers hold the database write lock so this cannot race with `remove`.
+    """
+    path = compressed_path(staged.hash, staged.codec)
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    os.replace(staged.path, path)
+    try:
+        os.remove(blob_path(staged.hash))
+    except FileNotFoundError:
+        pass
+
+
+def place(staged: StagedBlob) -> None:
+    """
+    Moves a staged blob to its content address, or drops it if identical content is already stored.
+    Callers run it on the database writer thread, after the commit that references the blob,
+    so it is ordered with `remove` of the same content.
+    """
+    if exists(staged.hash):
+        discard(staged)
+        return
+    if staged.base is not None:
+        path = delta_path(staged.hash)
+    elif staged.codec != codecs.NONE:
+        path = compressed_path(staged.hash, staged.codec)
+    else:
+        path = blob_path(staged.hash)
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    os.replace(staged.path, path)
+
+
+def discard(staged: StagedBlob) -> None:
+    try:
+        os.remove(staged.path)
+    except FileNotFoundError:
+        pass
+
+
+def _open(key: str) -> List[Tuple[BinaryIO, str]]:
+    """
+    Opens the file a stored blob is kept in, and for a delta the files of its base chain, as
+    (file, codec or DELTA) pairs. Open files stay readable even if the blob is removed meanwhile.
+    """
+    try:
+        return [(open(blob_path(key), "rb"), codecs.NONE)]
+    except FileNotFoundError:
+        pass
+    for codec in SUFFIXES:
+        try:
+            return [(open(compressed_path(key, codec), "rb"), codec)]
+        except FileNotFoundError:
+            continue
+    f = open(delta_path(key), "rb")
+    try:
+        # Chains are bounded by the keyframe interval, so the recursion stays shallow
+        return [(f, DELTA)] + _open(f.read(KEY_LENGTH).decode())
+    except BaseException:
+        f.close()
+        raise
+
+
+def _close(files: List[Tuple[BinaryIO, str]]) -> None:
+    for f, _ in files:
+        f.close()
+
+
+def _decode(files: List[Tuple[BinaryIO, str]], size: int) -> Iterator[bytes]:
+    f, kind = files[0]
+    if kind == codecs.NONE:
+        while data := f.read(size):
+            yield data
+    elif kind == DELTA:
+        with _seekable(files[1:], size) as base:
+            yield from delta.apply_stream(base, f, size)
+    else:
+        f.seek(SIZE_HEADER)
+        yield from codecs.decompress_stream(kind, f, size)
+
+
+@contextmanager
+def _seekable(files: List[Tuple[BinaryIO, str]], size: int) -> Iterator[BinaryIO]:
+    """Yields the content of opened blob files as a seekable file, decoded into a temp file if need be."""
+    f, kind = files[0]
+    if kind == codecs.NONE:
+        yield f
+        return
+    path = _tmp_path()
+    try:
+        with open(path, "w+b") as tmp:
+            for data in _decode(files, size):
+                tmp.write(data)
+            yield tmp
+    finally:
+        os.remove(path)
+
+
+def stream(key: str, size: int = COPY_SIZE) -> Iterator[bytes]:
+    """
+    Yields the content of a stored blob in chunks of at most `size` bytes, decoding as it goes.
+    The blob is opened before this returns, so a stream outlives the blob being released.
+    """
+    return _stream(_open(key), size)
+
+
+def _stream(files: List[Tuple[BinaryIO, str]], size: int) -> Iterator[bytes]:
+    try:
+        yield from _decode(files, size)
+    finally:
+        _close(files)
+
+
+def pieces(key: str, size: int) -> Iterator[bytes]:
+    """
+    Yields the content of a stored blob as pieces of exactly `size` bytes, but for the last.
+    Like `stream`, the blob is opened before this returns.
+    """
+    return _pieces(stream(key, size), size)
+
+
+def _pieces(chunks: Iterator[bytes], size: int) -> Iterator[bytes]:
+    buffer = bytearray()
+    try:
+        for data in chunks:
+            if not buffer and len(data) == size:
+                yield data
+                continue
+            buffer += data
+            while len(buffer) >= size:
+                yield bytes(buffer[:size])
+                del buffer[:size]
+        if buffer:
+            yield bytes(buffer)
+    finally:
+        chunks.close()
+
+
+def read(key: str) -> bytes:
+    return b"".join(stream(key))
+
+
+def remove(key: str) -> None:
+    for path in _paths(key):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
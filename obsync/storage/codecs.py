@@ -0,0 +1,86 @@
+"""
+Compression codecs for stored content.
+
+zstd needs the optional `zstandard` package; without it config falls back to zlib.
+"""
+import zlib
+from typing import BinaryIO, Iterator, Optional
+
+from obsync.config import config
+
+try:
+    import zstandard
+except ImportError:  # NOTE: optional dependency
+    zstandard = None
+
+NONE = "none"
+ZLIB = "zlib"
+ZSTD = "zstd"
+
+# Text formats Obsidian syncs and publishes; everything else is usually compressed already
+COMPRESSIBLE = {
+    "md", "canvas", "json", "txt", "csv", "html", "htm", "css", "js", "svg", "xml", "base",
+}
+
+# Skip content whose sample does not shrink below this ratio, e.g. encrypted vault revisions
+MIN_RATIO = 0.9
+SAMPLE_SIZE = 65536
+
+
+def default() -> str:
+    # config.init() already fell back to zlib if zstandard is missing
+    return config.Compression
+
+
+def choose(name: Optional[str]) -> str:
+    """Picks the codec for a file extension or path."""
+    extension = (name or "").rsplit("/", 1)[-1].rsplit(".", 1)[-1].lower()
+    return default() if extension in COMPRESSIBLE else NONE
+
+
+def compressor(codec: str):
+    if codec == ZSTD:
+        return zstandard.ZstdCompressor().compressobj()
+    return zlib.compressobj()
+
+
+def decompressor(codec: str):
+    if codec == ZSTD:
+        return zstandard.ZstdDecompressor().decompressobj()
+    return zlib.decompressobj()
+
+
+def compress(codec: str, data: bytes) -> bytes:
+    if codec == NONE:
+        return data
+    c = compressor(codec)
+    return c.compress(data) + c.flush()
+
+
+def decompress(codec: Optional[str], data: bytes) -> bytes:
+    if codec in (None, NONE):
+        return data
+    d = decompressor(codec)
+    return d.decompress(data) + d.flush()
+
+
+def decompress_stream(codec: str, source: BinaryIO, size: int) -> Iterator[bytes]:
+    """Decompresses `source` from its current position, yielding chunks of at most `size` bytes."""
+    if codec == ZSTD:
+        yield from zstandard.ZstdDecompressor().read_to_iter(source, read_size=size, write_size=size)
+        return
+    d = zlib.decompressobj()
+    while data := source.read(size):
+        while data:
+            if out := d.decompress(data, size):
+                yield out
+            data = d.unconsumed_tail
+    if out := d.flush():
+        yield out
+
+
+def worthwhile(codec: str, sample: bytes) -> bool:
+    """Tells from a leading sample whether compressing the whole content is likely to pay off."""
+    if codec == NONE or not sample:
+        return False
+    return len(compress(codec, sample[:SAMPLE_SIZE])) < min(len(sample), SAMPLE_SIZE) * MIN_RATIO
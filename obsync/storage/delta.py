@@ -0,0 +1,150 @@
+"""
+Binary delta format used by delta pushes and delta-encoded blobs.
+
+A delta is MAGIC followed by a sequence of ops, with every integer a LEB128 varint:
+    0x00 <length> <bytes>     insert literal bytes
+    0x01 <offset> <length>    copy bytes from the base
+"""
+from typing import BinaryIO, Iterator
+
+MAGIC = b"OBSDELTA1"
+INSERT = 0x00
+COPY = 0x01
+
+# Matches shorter than this are cheaper to send as literals
+BLOCK_SIZE = 32
+
+
+class DeltaError(ValueError):
+    pass
+
+
+def bound(size: int) -> int:
+    """The size of the largest sensible delta for `size` bytes of content: all of it as one literal."""
+    return len(MAGIC) + 1 + 10 + size
+
+
+def _write_varint(out: bytearray, n: int) -> None:
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return
+
+
+def _read_varint(data: memoryview, pos: int) -> tuple[int, int]:
+    n = shift = 0
+    while True:
+        if pos >= len(data):
+            raise DeltaError("Truncated delta")
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return n, pos
+        shift += 7
+
+
+def diff(base: bytes, target: bytes) -> bytes:
+    """Encodes `target` as copies from `base` plus literals, matching on BLOCK_SIZE-aligned base blocks."""
+    index = {}
+    for offset in range(0, len(base) - BLOCK_SIZE + 1, BLOCK_SIZE):
+        index.setdefault(base[offset : offset + BLOCK_SIZE], offset)
+
+    out = bytearray(MAGIC)
+    literal_start = pos = 0
+    while pos + BLOCK_SIZE <= len(target):
+        offset = index.get(target[pos : pos + BLOCK_SIZE])
+        if offset is None:
+            pos += 1
+            continue
+        length = BLOCK_SIZE
+        while (
+            pos + length < len(target)
+            and offset + length < len(base)
+            and target[pos + length] == base[offset + length]
+        ):
+            length += 1
+        if pos > literal_start:
+            out.append(INSERT)
+            _write_varint(out, pos - literal_start)
+            out += target[literal_start:pos]
+        out.append(COPY)
+        _write_varint(out, offset)
+        _write_varint(out, length)
+        pos += length
+        literal_start = pos
+
+    if literal_start < len(target):
+        out.append(INSERT)
+        _write_varint(out, len(target) - literal_start)
+        out += target[literal_start:]
+    return bytes(out)
+
+
+def apply(base: bytes, delta: bytes) -> bytes:
+    data = memoryview(delta)
+    if data[: len(MAGIC)] != MAGIC:
+        raise DeltaError("Not a delta")
+
+    out = bytearray()
+    pos = len(MAGIC)
+    while pos < len(data):
+        op = data[pos]
+        pos += 1
+        if op == INSERT:
+            length, pos = _read_varint(data, pos)
+            if pos + length > len(data):
+                raise DeltaError("Truncated delta")
+            out += data[pos : pos + length]
+            pos += length
+        elif op == COPY:
+            offset, pos = _read_varint(data, pos)
+            length, pos = _read_varint(data, pos)
+            if offset + length > len(base):
+                raise DeltaError("Copy outside of base")
+            out += base[offset : offset + length]
+        else:
+            raise DeltaError(f"Unknown delta op {op}")
+    return bytes(out)
+
+
+def _read_stream_varint(stream: BinaryIO) -> int:
+    n = shift = 0
+    while True:
+        byte = stream.read(1)
+        if not byte:
+            raise DeltaError("Truncated delta")
+        n |= (byte[0] & 0x7F) << shift
+        if not byte[0] & 0x80:
+            return n
+        shift += 7
+
+
+def apply_stream(base: BinaryIO, delta: BinaryIO, size: int) -> Iterator[bytes]:
+    """
+    Like `apply`, but reads the delta from its current position and the base by seeking, and yields
+    the result in chunks of at most `size` bytes, so neither side is ever held in memory whole.
+    """
+    if delta.read(len(MAGIC)) != MAGIC:
+        raise DeltaError("Not a delta")
+    while op := delta.read(1):
+        if op[0] == INSERT:
+            source, error = delta, "Truncated delta"
+            length = _read_stream_varint(delta)
+        elif op[0] == COPY:
+            offset = _read_stream_varint(delta)
+            length = _read_stream_varint(delta)
+            source, error = base, "Copy outside of base"
+            base.seek(offset)
+        else:
+            raise DeltaError(f"Unknown delta op {op[0]}")
+        while length:
+            data = source.read(min(length, size))
+            if not data:
+                raise DeltaError(error)
+            length -= len(data)
+            yield data
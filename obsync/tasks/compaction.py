@@ -0,0 +1,48 @@
+import asyncio
+from typing import Optional
+
+from obsync.config import config
+from obsync.db import vault, vaultfiles
+from obsync.logger import logger
+from obsync.utils import milisec
+
+_task: Optional[asyncio.Task] = None
+
+
+async def compact(vault_id: str) -> int:
+    """Prunes one vault a bounded slice at a time, yielding to other writers between slices."""
+    before = milisec(offset=-config.KeepDays * 24 * 60 * 60)
+    total, cursor = 0, None
+    while True:
+        deleted, cursor = await vaultfiles.compact_vault(
+            vault_id, config.KeepRevisions, before, config.CompactionBatchSize, cursor
+        )
+        total += deleted
+        if cursor is None:
+            return total
+        await asyncio.sleep(0)
+
+
+async def run() -> None:
+    while True:
+        try:
+            for vault_id in await vault.get_vault_ids():
+                deleted = await compact(vault_id)
+                if deleted:
+                    logger.info(f"Compacted {deleted} revisions of vault {vault_id}")
+        except Exception as e:
+            logger.error(f"Error compacting vaults: {e}")
+        await asyncio.sleep(config.CompactionIntervalS)
+
+
+def start() -> None:
+    global _task
+    if _task is None or _task.done():
+        _task = asyncio.create_task(run())
+
+
+def stop() -> None:
+    global _task
+    if _task is not None:
+        _task.cancel()
+        _task = None
@@ -0,0 +1,36 @@
+"""
+Picks the one process that runs the background jobs when uvicorn serves several workers.
+The first worker to take an exclusive lock on DATA_DIR/tasks.lock keeps it for its lifetime;
+SQLite drops the lock with the process, so a crashed worker never leaves it stale.
+"""
+import os
+import sqlite3
+from typing import Optional
+
+from obsync.config import config
+
+_conn: Optional[sqlite3.Connection] = None
+
+
+def acquire() -> bool:
+    """Returns whether this process runs the background jobs."""
+    global _conn
+    if _conn is not None:
+        return True
+    conn = sqlite3.connect(
+        os.path.join(config.DataDir, "tasks.lock"), timeout=0, isolation_level=None, check_same_thread=False
+    )
+    try:
+        conn.execute("BEGIN EXCLUSIVE")
+    except sqlite3.OperationalError:
+        conn.close()
+        return False
+    _conn = conn
+    return True
+
+
+def release() -> None:
+    global _conn
+    if _conn is not None:
+        _conn.close()
+        _conn = None
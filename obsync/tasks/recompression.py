@@ -0,0 +1,52 @@
+"""
+Compresses blobs stored before compression was enabled, vault revisions and published
+pages alike, in the background. New content is compressed as it is written.
+"""
+import asyncio
+from typing import Optional
+
+from obsync.config import config
+from obsync.db import blobs
+from obsync.logger import logger
+from obsync.storage import blobstore, codecs
+
+_task: Optional[asyncio.Task] = None
+
+
+async def recompress_blobs() -> int:
+    """Considers one batch of blobs. Returns the number examined, 0 once all are done."""
+    batch = await blobs.get_uncompressed_blobs(config.RecompressBatchSize)
+    if not batch:
+        return 0
+    results = {}
+    for key, size, name in batch:
+        results[key] = await asyncio.to_thread(
+            blobstore.recompress, key, size, codecs.choose(name)
+        )
+    compressed = await blobs.set_codecs(results)
+    if compressed:
+        logger.info(f"Recompressed {compressed} blobs")
+    return len(batch)
+
+
+async def run() -> None:
+    try:
+        while await recompress_blobs():
+            await asyncio.sleep(0)
+    except Exception as e:
+        logger.error(f"Error recompressing stored content: {e}")
+
+
+def start() -> None:
+    global _task
+    if config.Compression == codecs.NONE:
+        return
+    if _task is None or _task.done():
+        _task = asyncio.create_task(run())
+
+
+def stop() -> None:
+    global _task
+    if _task is not None:
+        _task.cancel()
+        _task = None
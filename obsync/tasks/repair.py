@@ -0,0 +1,22 @@
+"""
+Recomputes vault usage counters from the stored revisions.
+
+Usage:
+    python -m obsync.tasks.repair [vault_id ...]
+"""
+import sys
+import asyncio
+
+import obsync.db.models
+from obsync.db import vault, vaultfiles
+from obsync.logger import logger
+
+
+async def repair(vault_ids: list) -> None:
+    for vault_id in vault_ids or await vault.get_vault_ids():
+        size = await vaultfiles.recompute_vault_size(vault_id)
+        logger.info(f"Vault {vault_id} uses {size} bytes")
+
+
+if __name__ == "__main__":
+    asyncio.run(repair(sys.argv[1:]))
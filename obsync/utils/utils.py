@@ -2,22 +2,93 @@ from jose import jwt
 import string
 import hashlib
 import random
+import threading
+from collections import OrderedDict
+from typing import Optional
 from obsync.config import config
 from loguru import logger
 import time
 
 
-def milisec(time: float = time.time(), offset: float = 0) -> int:
-    return int((time + offset) * 1000)
+def milisec(t: Optional[float] = None, offset: float = 0) -> int:
+    # NOTE: defaulting to time.time() in the signature would freeze it at import
+    if t is None:
+        t = time.time()
+    return int((t + offset) * 1000)
+
+
+class TokenCache:
+    """
+    Bounded LRU of verified tokens to their email, so hot endpoints skip signature checks.
+    Entries expire after `ttl` seconds (or at the token's own `exp`), and the whole cache
+    is dropped when `config.Secret` changes.
+    """
+
+    def __init__(self, maxsize: int = 4096, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self._secret = None
+        self._lock = threading.Lock()
+
+    def _check_secret(self) -> None:
+        if self._secret is not config.Secret:
+            self._entries.clear()
+            self._secret = config.Secret
+
+    def get(self, token: str) -> Optional[str]:
+        with self._lock:
+            self._check_secret()
+            entry = self._entries.get(token)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._entries[token]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, token: str, email: str, exp: Optional[float] = None) -> None:
+        expires = time.monotonic() + self.ttl
+        if exp is not None:
+            expires = min(expires, time.monotonic() + exp - time.time())
+        with self._lock:
+            self._check_secret()
+            self._entries[token] = (email, expires)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate_email(self, email: str) -> None:
+        with self._lock:
+            for token in [t for t, (e, _) in self._entries.items() if e == email]:
+                del self._entries[token]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+
+token_cache = TokenCache()
 
 
 def get_jwt_email(jwt_string):
+    email = token_cache.get(jwt_string)
+    if email is not None:
+        return email
     try:
         decoded = jwt.decode(jwt_string, config.Secret)
-        print(decoded)
+        logger.debug(f"Decoded JWT: {decoded}")
         email = decoded.get("email")
         if email is None:
             raise ValueError("Invalid token: email not found")
+        token_cache.put(jwt_string, email, decoded.get("exp"))
         return email
     except Exception as e:
         logger.error(f"Error decoding JWT: {e}")
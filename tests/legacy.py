@@ -0,0 +1,58 @@
+"""
+Builds databases in the shape obsync created before its migrations, for tests and benchmarks.
+"""
+import random
+
+from sqlalchemy import text
+
+
+# Tables as they were created before the blob store and index migrations
+LEGACY_SCHEMA = [
+    """
+CREATE TABLE vaults (
+    id TEXT NOT NULL PRIMARY KEY, user_email TEXT NOT NULL, created INTEGER NOT NULL,
+    host TEXT NOT NULL, name TEXT NOT NULL, password TEXT NOT NULL, salt TEXT NOT NULL,
+    size INTEGER, version INTEGER NOT NULL, keyhash TEXT NOT NULL
+)
+""",
+    """
+CREATE TABLE files (
+    uid INTEGER NOT NULL PRIMARY KEY,
+    vault_id TEXT, hash TEXT, path TEXT, extension TEXT, size INTEGER,
+    created INTEGER, modified INTEGER, folder BOOLEAN, deleted BOOLEAN,
+    data BLOB, newest BOOLEAN, is_snapshot BOOLEAN
+)
+""",
+    "CREATE TABLE blobs (hash TEXT NOT NULL PRIMARY KEY, size INTEGER NOT NULL, refcount INTEGER NOT NULL)",
+]
+
+def populate(conn, rows: int, vaults: int, revisions: int) -> None:
+    for statement in LEGACY_SCHEMA:
+        conn.execute(text(statement))
+    conn.execute(
+        text(
+            "INSERT INTO vaults (id, user_email, created, host, name, password, salt, version, keyhash) "
+            "VALUES (:id, '', 0, '', '', '', '', :version, '')"
+        ),
+        [{"id": f"vault-{v}", "version": rows} for v in range(vaults)],
+    )
+    batch = []
+    for uid in range(rows):
+        note = uid // revisions
+        batch.append({
+            "vault": f"vault-{note % vaults}",
+            "path": f"notes/{note}.md",
+            "modified": uid,
+            "newest": uid % revisions == revisions - 1,
+            "deleted": random.random() < 0.05,
+            "snapshot": random.random() < 0.5,
+        })
+        if len(batch) == 10000 or uid == rows - 1:
+            conn.execute(
+                text(
+                    "INSERT INTO files (vault_id, path, size, modified, newest, deleted, is_snapshot) "
+                    "VALUES (:vault, :path, 1, :modified, :newest, :deleted, :snapshot)"
+                ),
+                batch,
+            )
+            batch = []
@@ -0,0 +1,139 @@
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+import obsync.db.models
+from obsync.db.db import SessionFactory, ReadSessionFactory
+
+
+def test_journal_mode_is_wal():
+    with SessionFactory() as session:
+        assert session.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+
+
+def test_read_sessions_are_query_only():
+    with ReadSessionFactory() as session:
+        assert session.execute(text("SELECT count(*) FROM files")).scalar() >= 0
+        with pytest.raises(OperationalError):
+            session.execute(text("DELETE FROM files"))
+
+
+def test_write_sessions_hold_the_write_lock_from_the_start():
+    import sqlite3
+    from obsync.db.db import db_file_path
+
+    other = sqlite3.connect(db_file_path, timeout=0, isolation_level=None)
+    with SessionFactory() as session:
+        # Only a read so far, yet no other process may write until this commits
+        session.execute(text("SELECT count(*) FROM files")).scalar()
+        with pytest.raises(sqlite3.OperationalError, match="locked"):
+            other.execute("BEGIN IMMEDIATE")
+        session.commit()
+    other.execute("BEGIN IMMEDIATE")
+    other.execute("ROLLBACK")
+    other.close()
+
+
+def test_migrate_legacy_database_in_place(tmp_path):
+    from sqlalchemy import create_engine, inspect
+    from tests.legacy import populate
+    from obsync.db.migrations import migrate, MIGRATIONS
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    with engine.begin() as conn:
+        populate(conn, rows=100, vaults=2, revisions=5)
+
+    migrate(engine)
+    with engine.connect() as conn:
+        assert conn.execute(text("PRAGMA user_version")).scalar() == len(MIGRATIONS)
+        indexes = {ix["name"] for ix in inspect(conn).get_indexes("files")}
+        assert {"ix_files_vault_newest_deleted", "ix_files_vault_path_modified"} <= indexes
+        assert not {"ix_files_vault_snapshot", "ix_files_path_modified"} & indexes
+        assert conn.execute(text("SELECT count(*) FROM files")).scalar() == 100
+    engine.dispose()
+
+
+def _legacy_publish_database(path, rows):
+    import zlib
+    from sqlalchemy import create_engine
+
+    engine = create_engine(f"sqlite:///{path}")
+    obsync.db.models.Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(text("DROP TABLE publish_files"))
+        conn.execute(text(
+            "CREATE TABLE publish_files (path TEXT PRIMARY KEY, ctime INT, hash TEXT, mtime INT, "
+            "size INT, data TEXT, slug TEXT UNIQUE, deleted INT, codec TEXT)"
+        ))
+        for i, (data, codec, hash) in enumerate(rows):
+            if codec == "zlib":
+                data = zlib.compress(data.encode())
+            conn.execute(
+                text("INSERT INTO publish_files VALUES (:path, 1, :hash, 2, 0, :data, :slug, 0, :codec)"),
+                {"path": f"{i}.md", "hash": hash, "data": data, "slug": f"site-{i}", "codec": codec},
+            )
+        conn.execute(text("PRAGMA user_version = 7"))
+    return engine
+
+
+def test_published_pages_move_into_blobstore(tmp_path):
+    import hashlib
+    from obsync.db.migrations import migrate
+    from obsync.storage import blobstore
+
+    pages = [f"plain page {tmp_path}", f"compressed page {tmp_path}" * 50]
+    engine = _legacy_publish_database(tmp_path / "legacy.db", [(pages[0], None, "a"), (pages[1], "zlib", "b")])
+    migrate(engine)
+    with engine.connect() as conn:
+        stored = conn.execute(text("SELECT slug, path, blob FROM publish_files ORDER BY path")).fetchall()
+    assert [(row.slug, row.path) for row in stored] == [("site-0", "0.md"), ("site-1", "1.md")]
+    assert [blobstore.read(row.blob) for row in stored] == [page.encode() for page in pages]
+    engine.dispose()
+
+    # A migration that fails part-way places none of the content it staged
+    page = f"never placed {tmp_path}"
+    engine = _legacy_publish_database(tmp_path / "failing.db", [(page, None, "a"), ("bad", None, None)])
+    with pytest.raises(Exception):
+        migrate(engine)
+    assert not blobstore.exists(hashlib.sha256(page.encode()).hexdigest())
+    engine.dispose()
+
+
+def test_init_db_propagates_migration_errors(monkeypatch):
+    from obsync.db import db
+
+    def broken(engine):
+        raise RuntimeError("migration failed")
+
+    monkeypatch.setattr(db, "migrate", broken)
+    with pytest.raises(RuntimeError, match="migration failed"):
+        db.init_db()
+
+
+def test_blob_changes_wait_for_commit():
+    import os
+    from obsync.db import blobs
+    from obsync.storage import blobstore
+
+    staged = blobstore.stage(os.urandom(64))
+    with SessionFactory() as session:
+        blobs.attach(session, staged)
+        assert not blobstore.exists(staged.hash)
+        session.rollback()
+    assert not blobstore.exists(staged.hash) and not os.path.exists(staged.path)
+
+    staged = blobstore.stage(os.urandom(64))
+    with SessionFactory() as session:
+        blobs.attach(session, staged)
+        session.commit()
+    assert blobstore.exists(staged.hash)
+
+    with SessionFactory() as session:
+        blobs.release(session, [staged.hash])
+        session.rollback()
+    assert blobstore.exists(staged.hash)
+    with SessionFactory() as session:
+        blobs.release(session, [staged.hash])
+        assert blobstore.exists(staged.hash)
+        session.commit()
+    assert not blobstore.exists(staged.hash)
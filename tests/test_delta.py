@@ -0,0 +1,70 @@
+import os
+
+import pytest
+
+from obsync.storage import delta
+
+
+def test_diff_apply_roundtrip():
+    base = os.urandom(10000)
+    target = b"prefix" + base[100:5000] + os.urandom(50) + base[5000:]
+    patch = delta.diff(base, target)
+    assert len(patch) < 200
+    assert delta.apply(base, patch) == target
+    assert delta.apply(b"", delta.diff(b"", target)) == target
+
+
+def test_apply_rejects_bad_input():
+    with pytest.raises(delta.DeltaError):
+        delta.apply(b"", b"garbage")
+    with pytest.raises(delta.DeltaError):
+        delta.apply(b"short", delta.MAGIC + b"\x01\x00\x7f")
+    with pytest.raises(delta.DeltaError):
+        delta.apply(b"", delta.MAGIC + b"\x00\x05ab")
+
+
+def test_apply_stream_matches_apply():
+    import io
+
+    base = os.urandom(10000)
+    target = base[2000:9000] + os.urandom(3000) + base[:500]
+    patch = delta.diff(base, target)
+    chunks = list(delta.apply_stream(io.BytesIO(base), io.BytesIO(patch), 1024))
+    assert b"".join(chunks) == target
+    assert max(len(chunk) for chunk in chunks) <= 1024
+    with pytest.raises(delta.DeltaError):
+        list(delta.apply_stream(io.BytesIO(b"short"), io.BytesIO(delta.MAGIC + b"\x01\x00\x7f"), 1024))
+
+
+def test_compressed_and_delta_blobs_are_read_in_pieces(monkeypatch):
+    from obsync.config import config
+    from obsync.storage import blobstore, codecs
+
+    monkeypatch.setattr(config, "Compression", codecs.ZLIB)
+    base = b"a line of text that compresses well\n" * 3000
+    staged = blobstore.compress(blobstore.stage(base), codecs.ZLIB)
+    assert staged.codec == codecs.ZLIB
+    key = staged.hash
+    blobstore.place(staged)
+
+    edited = base[:50000] + b"an edit" + base[50000:]
+    patch = blobstore.stage(delta.diff(base, edited))
+    rebuilt = blobstore.rebuild(key, patch, limit=len(edited))
+    assert rebuilt.size == len(edited)
+    blobstore.place(rebuilt)
+
+    for content, blob in ((base, key), (edited, rebuilt.hash)):
+        pieces = list(blobstore.pieces(blob, 4096))
+        assert all(len(piece) == 4096 for piece in pieces[:-1])
+        assert b"".join(pieces) == content
+
+    with pytest.raises(delta.DeltaError):
+        blobstore.rebuild(key, blobstore.stage(delta.diff(base, edited)), limit=len(edited) - 1)
+
+    # Opened when asked for, so pieces still come after the blob is removed
+    content = blobstore.pieces(rebuilt.hash, 4096)
+    blobstore.remove(rebuilt.hash)
+    blobstore.remove(key)
+    assert b"".join(content) == edited
+    with pytest.raises(FileNotFoundError):
+        blobstore.pieces(key, 4096)
@@ -0,0 +1,266 @@
+import hashlib
+import os
+import uuid
+
+from fastapi.testclient import TestClient
+from obsync.config import config
+from obsync.main import app
+
+
+client = TestClient(app)
+
+email = f"{uuid.uuid4().hex}@example.com"
+
+
+def _token() -> str:
+    client.post("/user/signup", json={"email": email, "password": "password123", "name": "Publish"})
+    return client.post("/user/signin", json={"email": email, "password": "password123"}).json()["token"]
+
+
+token = _token()
+
+
+def _new_site() -> dict:
+    assert client.post("/publish/create", json={"token": token}).status_code == 200
+    return client.post("/api/list", json={"token": token}).json()["sites"][-1]
+
+
+def _upload(site_id: str, path: str, data: bytes, obs_hash: str = None):
+    return client.post(
+        "/api/upload",
+        content=data,
+        headers={
+            "obs-token": token,
+            "obs-id": site_id,
+            "obs-path": path,
+            "obs-hash": obs_hash or hashlib.sha256(data).hexdigest(),
+            "content-length": str(len(data)),
+        },
+    )
+
+
+def test_published_page_is_compressed_and_served(monkeypatch):
+    from obsync.db.db import SessionFactory
+    from obsync.db.models import Blob, PublishFile
+    from obsync.storage import codecs
+
+    monkeypatch.setattr(config, "Compression", codecs.ZLIB)
+    site = _new_site()
+    page = "# Published\n" + "A paragraph of published markdown.\n" * 300
+    assert _upload(site["id"], "notes/page.md", page.encode()).status_code == 200
+
+    with SessionFactory() as session:
+        stored = session.query(PublishFile).filter(PublishFile.slug == site["id"]).one()
+        assert session.get(Blob, stored.blob).codec == codecs.ZLIB
+
+    response = client.get(f"/publish/{site['slug']}/notes/page.md")
+    assert response.status_code == 200
+    assert response.content == page.encode()
+    assert response.headers["content-type"] == "text/markdown; charset=utf-8"
+
+
+def test_recompression_job_compresses_published_pages(monkeypatch):
+    import asyncio
+    from obsync.db.db import SessionFactory
+    from obsync.db.models import Blob, PublishFile
+    from obsync.storage import codecs
+    from obsync.tasks import recompression
+
+    monkeypatch.setattr(config, "Compression", codecs.NONE)
+    site = _new_site()
+    page = "# Migrated\n" + "A page stored before compression was enabled.\n" * 200
+    assert _upload(site["id"], "migrated.md", page.encode()).status_code == 200
+    with SessionFactory() as session:
+        key = session.query(PublishFile.blob).filter(PublishFile.slug == site["id"]).scalar()
+        # As left by the publish migration: no revision names the blob, only the page's path
+        session.query(Blob).filter(Blob.hash == key).update({Blob.codec: None})
+        session.commit()
+
+    monkeypatch.setattr(config, "Compression", codecs.ZLIB)
+    while asyncio.run(recompression.recompress_blobs()):
+        pass
+    with SessionFactory() as session:
+        assert session.query(Blob.codec).filter(Blob.hash == key).scalar() == codecs.ZLIB
+    assert client.get(f"/publish/{site['slug']}/migrated.md").content == page.encode()
+    # Frees the slot, other tests need fresh sites within MAX_SITES_PER_USER
+    assert client.post("/publish/delete", json={"token": token, "site_uid": site["id"]}).status_code == 200
+
+
+def test_binary_files_round_trip():
+    from obsync.db import publish
+
+    site = _new_site()
+    image = bytes(range(256)) * 64
+    assert _upload(site["id"], "assets/image.png", image).status_code == 200
+    assert _upload(site["id"], "index.md", b"# Index").status_code == 200
+
+    response = client.get(f"/publish/{site['slug']}/assets/image.png")
+    assert response.status_code == 200
+    assert response.content == image
+    assert response.headers["content-type"] == "image/png"
+    assert client.get(f"/publish/{site['slug']}/index.md").content == b"# Index"
+
+    # Too large to keep in memory, so it is streamed from the blob store
+    large = image * ((publish.INLINE_BYTES // len(image)) + 1)
+    assert _upload(site["id"], "assets/large.bin", large).status_code == 200
+    response = client.get(f"/publish/{site['slug']}/assets/large.bin")
+    assert response.content == large
+    assert response.headers["content-type"] == "application/octet-stream"
+
+
+def test_upload_is_verified_and_bounded(monkeypatch):
+    site = _new_site()
+    assert _upload(site["id"], "bad.md", b"content", obs_hash="0" * 64).status_code == 400
+    assert client.get(f"/publish/{site['slug']}/bad.md").status_code != 200
+
+    monkeypatch.setattr(config, "PublishMaxBytes", 16)
+    assert _upload(site["id"], "big.md", b"x" * 17).status_code == 413
+    assert _upload(site["id"], "small.md", b"x" * 16).status_code == 200
+
+
+def test_published_page_is_revalidated_with_etag():
+    site = _new_site()
+    assert _upload(site["id"], "index.md", b"# Hello").status_code == 200
+    url = f"/publish/{site['slug']}/index.md"
+
+    response = client.get(url)
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+    assert response.headers["cache-control"] == config.PublishCacheControl
+    assert "last-modified" in response.headers
+
+    cached = client.get(url, headers={"If-None-Match": etag})
+    assert cached.status_code == 304
+    assert cached.content == b""
+    assert client.get(url, headers={"If-Modified-Since": response.headers["last-modified"]}).status_code == 304
+    assert client.get(url, headers={"If-None-Match": '"stale"'}).status_code == 200
+
+    client.post("/api/cache", json={"token": token, "id": site["id"], "cache_control": "Public,  max-age=300"})
+    assert client.get(url).headers["cache-control"] == "public, max-age=300"
+    for bad in ("public\r\nSet-Cookie: a=b", "max-age=soon", "public=1", "x-custom"):
+        response = client.post("/api/cache", json={"token": token, "id": site["id"], "cache_control": bad})
+        assert response.status_code == 400
+    assert client.get(url).headers["cache-control"] == "public, max-age=300"
+
+    assert _upload(site["id"], "index.md", b"# Hello again").status_code == 200
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 200
+
+    index = client.get(f"/publish/{site['slug']}")
+    assert index.status_code == 200
+    assert [f[0] for f in index.json()["files"]] == ["index.md"]
+    assert client.get(f"/publish/{site['slug']}", headers={"If-None-Match": index.headers["etag"]}).status_code == 304
+
+
+def test_page_cache_is_byte_bounded_lru():
+    from obsync.db.publish import PageCache
+
+    cache = PageCache(maxbytes=1000)
+    for i in range(10):
+        cache.put("slug", f"{i}.md", f"page {i}", "site", 100, cache.generation())
+    assert cache.get("slug", "0.md") == "page 0"
+    cache.put("slug", "10.md", "page 10", "site", 100, cache.generation())
+    # 1.md is now the least recently used, 0.md was just read
+    assert cache.get("slug", "1.md") is None
+    assert cache.get("slug", "0.md") == "page 0"
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["bytes"] == 1000
+    cache.put("slug", "huge.md", "huge", "site", 500, cache.generation())
+    assert cache.get("slug", "huge.md") is None
+
+    generation = cache.generation()
+    cache.invalidate("site", "0.md")
+    assert cache.get("slug", "0.md") is None
+    cache.put("slug", "0.md", "stale", "site", 100, generation)
+    assert cache.get("slug", "0.md") is None
+    cache.invalidate("site")
+    assert cache.stats()["entries"] == 0
+
+
+def test_published_pages_are_cached_and_invalidated():
+    from obsync.db.publish import page_cache
+
+    site = _new_site()
+    url = f"/publish/{site['slug']}/cached.md"
+    assert _upload(site["id"], "cached.md", b"first").status_code == 200
+    assert client.get(url).content == b"first"
+    hits = page_cache.hits
+    assert client.get(url).content == b"first"
+    assert page_cache.hits > hits
+
+    assert _upload(site["id"], "cached.md", b"second").status_code == 200
+    assert client.get(url).content == b"second"
+
+    client.post("/api/slug", json={"token": token, "id": site["id"], "slug": f"renamed-{site['id']}"})
+    assert client.get(url).status_code == 404
+    url = f"/publish/renamed-{site['id']}/cached.md"
+    assert client.get(url).content == b"second"
+
+    client.post("/api/remove", json={"token": token, "id": site["id"], "path": "cached.md"})
+    assert client.get(url).status_code != 200
+
+    metrics = client.get("/api/metrics").json()["publish_cache"]
+    assert metrics["hits"] > 0 and 0 < metrics["hit_ratio"] <= 1
+
+
+def test_site_index_is_paged_metadata(monkeypatch):
+    from obsync.db import publish as publish_db
+
+    site = _new_site()
+    paths = ["a.md", "docs/b.md", "docs/c.md", "docs/d.png", "docsx.md", "e.md"]
+    for path in paths:
+        assert _upload(site["id"], path, path.encode()).status_code == 200
+
+    index = client.get(f"/publish/{site['slug']}").json()
+    assert index["fields"] == ["path", "hash", "size", "ctime", "mtime"]
+    assert [f[0] for f in index["files"]] == paths
+    assert index["files"][0][1:3] == [hashlib.sha256(b"a.md").hexdigest(), 4]
+    assert index["next"] is None
+
+    listed, after = [], ""
+    while True:
+        page = client.get(f"/publish/{site['slug']}", params={"prefix": "docs/", "after": after, "limit": 2}).json()
+        listed += [f[0] for f in page["files"]]
+        if page["next"] is None:
+            break
+        after = page["next"]
+    assert listed == ["docs/b.md", "docs/c.md", "docs/d.png"]
+
+    monkeypatch.setattr(config, "PublishIndexPageSize", 4)
+    assert len(client.get(f"/publish/{site['slug']}", params={"limit": 100}).json()["files"]) == 4
+
+    listing = client.post("/publish/list", json={"token": token, "id": site["id"], "limit": 5}).json()
+    assert listing["owner"] and listing["more"]
+    assert [f["path"] for f in listing["files"]] == paths[:4]
+    assert set(listing["files"][0]) == {"path", "hash", "size", "ctime", "mtime"}
+    # Stock clients send no limit and ignore `more`, so they still get the whole site
+    listing = client.post("/publish/list", json={"token": token, "id": site["id"]}).json()
+    assert len(listing["files"]) == len(paths) and "more" not in listing
+
+    # Prefixes whose last character cannot be incremented still list, with no upper bound
+    for prefix in ("e.md\U0010ffff", "\U0010ffff", "docs/\ud7ff"):
+        page = client.get(f"/publish/{site['slug']}", params={"prefix": prefix})
+        assert page.status_code == 200 and page.json()["files"] == []
+    assert publish_db._prefix_end("a\U0010ffff") == "b"
+    assert publish_db._prefix_end("a\ud7ff") == "a\ue000"
+
+
+def test_slugs_are_resolved_in_batches(monkeypatch):
+    from obsync.db import publish as publish_db
+
+    monkeypatch.setattr(publish_db, "CHUNK_SIZE", 2)
+    sites = [_new_site() for _ in range(3)]
+    ids = [site["id"] for site in sites] + ["missing", sites[0]["id"]]
+    slugs = client.post("/api/slugs", json={"token": token, "ids": ids}).json()
+    assert slugs == {site["id"]: site["slug"] for site in sites}
+
+
+def test_streamed_page_outlives_its_blob():
+    from obsync.storage import blobstore
+
+    data = os.urandom(10000)
+    staged = blobstore.stage(data)
+    blobstore.place(staged)
+    content = blobstore.stream(staged.hash, 1024)
+    # Released by a concurrent upload after the response was built
+    blobstore.remove(staged.hash)
+    assert b"".join(content) == data
@@ -0,0 +1,29 @@
+from jose import jwt
+
+from obsync.config import config
+from obsync.utils import get_jwt_email, TokenCache
+
+
+def test_token_cache_hits_and_invalidation(monkeypatch):
+    cache = TokenCache(maxsize=2)
+    monkeypatch.setattr("obsync.utils.utils.token_cache", cache)
+    token = jwt.encode({"email": "cache@example.com"}, config.Secret, algorithm="HS256")
+
+    assert get_jwt_email(token) == "cache@example.com"
+    assert get_jwt_email(token) == "cache@example.com"
+    assert cache.stats() == {"hits": 1, "misses": 1, "size": 1}
+
+    cache.invalidate_email("cache@example.com")
+    assert cache.get(token) is None
+
+
+def test_token_cache_is_bounded_and_dropped_on_secret_rotation(monkeypatch):
+    cache = TokenCache(maxsize=2)
+    for i in range(3):
+        cache.put(f"token-{i}", f"{i}@example.com")
+    assert cache.get("token-0") is None
+    assert cache.get("token-2") == "2@example.com"
+
+    monkeypatch.setattr(config, "Secret", b"rotated")
+    assert cache.get("token-2") is None
+    assert cache.stats()["size"] == 0
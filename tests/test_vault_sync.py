@@ -0,0 +1,555 @@
+import asyncio
+import os
+import uuid
+
+import pytest
+
+from fastapi.testclient import TestClient
+from obsync.config import config
+from obsync.main import app
+from obsync.storage import blobstore
+
+
+client = TestClient(app)
+
+email = f"{uuid.uuid4().hex}@example.com"
+keyhash = "test-keyhash"
+
+
+def _token() -> str:
+    client.post("/user/signup", json={"email": email, "password": "password123", "name": "Sync"})
+    return client.post("/user/signin", json={"email": email, "password": "password123"}).json()["token"]
+
+
+token = _token()
+
+
+def _new_vault() -> str:
+    response = client.post(
+        "/vault/create",
+        json={"token": token, "name": "vault", "salt": "salt", "keyhash": keyhash},
+    )
+    assert response.status_code == 200
+    return response.json()["id"]
+
+
+def _connect(ws, vault_id: str, version: int = 0):
+    ws.send_json({
+        "op": "init",
+        "token": token,
+        "id": vault_id,
+        "keyhash": keyhash,
+        "version": version,
+        "initial": version == 0,
+        "device": "pytest",
+    })
+    assert ws.receive_json() == {"res": "ok"}
+    messages = []
+    while True:
+        msg = ws.receive_json()
+        if msg.get("op") == "ready":
+            return msg, messages
+        messages.append(msg)
+
+
+def _push(ws, path: str, data: bytes, pieces: int = 1, **fields) -> int:
+    ws.send_json({
+        "op": "push",
+        "path": path,
+        "extension": "md",
+        "hash": uuid.uuid4().hex,
+        "ctime": 0,
+        "mtime": 0,
+        "folder": False,
+        "deleted": False,
+        "size": len(data),
+        "pieces": pieces,
+        **fields,
+    })
+    step = -(-len(data) // pieces)
+    for i in range(pieces):
+        assert ws.receive_json() == {"res": "next"}
+        ws.send_bytes(data[i * step : (i + 1) * step])
+    broadcast = ws.receive_json()
+    assert broadcast["path"] == path
+    assert ws.receive_json() == {"op": "ok"}
+    return broadcast["uid"]
+
+
+def _pull(ws, uid: int) -> bytes:
+    ws.send_json({"op": "pull", "uid": uid})
+    header = ws.receive_json()
+    data = b"".join(ws.receive_bytes() for _ in range(header["pieces"]))
+    assert len(data) == header["size"]
+    return data
+
+
+def test_push_pull_roundtrip():
+    vault_id = _new_vault()
+    with client.websocket_connect("/ws.obsidian.md") as ws:
+        _connect(ws, vault_id)
+        data = os.urandom(4096)
+        uid = _push(ws, "notes/a.md", data, pieces=3)
+        assert _pull(ws, uid) == data
+
+
+def test_pull_is_split_into_pieces(monkeypatch):
+    from obsync.db.db import SessionFactory
+    from obsync.db.models import File
+
+    monkeypatch.setattr(config, "PieceSize", 1000)
+    vault_id = _new_vault()
+    with client.websocket_connect("/ws.obsidian.md") as ws:
+        _connect(ws, vault_id)
+        data = os.urandom(2500)
+        uid = _push(ws, "big.pdf", data)
+        ws.send_json({"op": "pull", "uid": uid})
+        assert ws.receive_json()["pieces"] == 3
+        pieces = [ws.receive_bytes() for _ in range(3)]
+        assert [len(p) for p in pieces] == [1000, 1000, 500]
+        assert b"".join(pieces) == data
+
+        # Content released before the pull opened it is an error for this pull, not the connection
+        with SessionFactory() as session:
+            key = session.query(File.blob).filter(File.uid == uid).scalar()
+        blobstore.remove(key)
+        ws.send_json({"op": "pull", "uid": uid})
+        assert ws.receive_json() == {"error": "file not found"}
+        ws.send_json({"op": "ping"})
+        assert ws.receive_json() == {"op": "pong"}
+
+
+def test_reconnect_only_receives_changes_since_version():
+    vault_id = _new_vault()
+    with client.websocket_connect("/ws.obsidian.md") as ws:
+        _connect(ws, vault_id)
+        _push(ws, "a.md", b"a")
+        _push(ws, "b.md", b"b")
+
+    with client.websocket_connect("/ws.obsidian.md") as ws:
+        ready, pushes = _connect(ws, vault_id)
+        assert sorted(p["path"] for p in pushes) == ["a.md", "b.md"]
+        version = ready["version"]
+        _push(ws, "c.md", b"c")
+
+    with client.websocket_connect("/ws.obsidian.md") as ws:
+        ready, pushes = _connect(ws, vault_id, version)
+        assert [p["path"] for p in pushes] == ["c.md"]
+        version = ready["version"]
+        ws.send_json({"op": "push", "path": "a.md", "deleted": True, "size": 0})
+        assert ws.receive_json()["deleted"] is True
+        assert ws.receive_json() == {"op": "ok"}
+
+    with client.websocket_connect("/ws.obsidian.md") as ws:
+        ready, pushes = _connect(ws, vault_id, version)
+        assert [(p["path"], p["deleted"]) for p in pushes] == [("a.md", True)]
+
+
+def test_initial_listing_is_paged(monkeypatch):
+    from obsync.routes import ws as ws_routes
+
+    monkeypatch.setattr(ws_routes, "LISTING_BATCH_SIZE", 2)
+    vault_id = _new_vault()
+    paths = [f"page/{i}.md" for i in range(5)]
+    with client.websocket_connect("/ws.obsidian.md") as ws:
+        _connect(ws, vault_id)
+        for path in paths:
+            _push(ws, path, path.encode())
+
+    with client.websocket_connect("/ws.obsidian.md") as ws:
+        ready, pushes = _connect(ws, vault_id)
+        assert [p["path"] for p in pushes] == paths
+
+
+def test_compaction_keeps_newest_revisions(monkeypatch):
+    from obsync.db.db import SessionFactory
+    from obsync.db.models import File
+    from obsync.tasks import compaction
+
+    vault_id = _new_vault()
+    with client.websocket_connect("/ws.obsidian.md") as ws:
+        _connect(ws, vault_id)
+        uids = [_push(ws, "draft.md", f"rev {i}".encode()) for i in range(4)]
+        others = [_push(ws, "other.md", f"other {i}".encode()) for i in range(3)]
+
+    monkeypatch.setattr(config, "KeepRevisions", 2)
+    monkeypatch.setattr(config, "KeepDays", -1)
+    # Slices smaller than a path's history, so ranks have to carry over between them
+    monkeypatch.setattr(config, "CompactionBatchSize", 2)
+    assert asyncio.run(compaction.compact(vault_id)) == 3
+
+    with SessionFactory() as session:
+        kept = [row.uid for row in session.query(File.uid).filter(File.vault_id == vault_id)]
+    assert sorted(kept) == uids[2:] + others[1:]
+
+
+def test_background_jobs_run_in_one_process_only(tmp_path, monkeypatch):
+    import subprocess
+    import sys
+    from obsync.tasks import leader
+
+    monkeypatch.setattr(config, "DataDir", str(tmp_path))
+    script = (
+        "from obsync.config import config; from obsync.tasks import leader; "
+        f"config.DataDir = {str(tmp_path)!r}; print(leader.acquire())"
+    )
+    other = [sys.executable, "-c", script]
+    assert leader.acquire()
+    try:
+        assert subprocess.run(other, capture_output=True, text=True).stdout.split()[-1] == "False"
+    finally:
+        leader.release()
+
+
+def test_size_is_counted_and_quota_enforced(monkeypatch):
+    vault_id = _new_vault()
+    with client.websocket_connect("/ws.obsidian.md") as ws:
+        _connect(ws, vault_id)
+        _push(ws, "a.md", b"12345")
+        _push(ws, "a.md", b"123")
+        ws.send_json({"op": "size"})
+        assert ws.receive_json()["size"] == 8
+
+        monkeypatch.setattr(config, "MaxStorageBytes", 10)
+        ws.send_json({"op": "push", "path": "big.md", "size": 5, "pieces": 1})
+        assert "error" in ws.receive_json()
+
+        # Declaring less than is sent does not get content past the quota
+        ws.send_json({"op": "push", "path": "big.md", "size": 1, "pieces": 1})
+        assert ws.receive_json() == {"res": "next"}
+        ws.send_bytes(b"123456")
+        assert ws.receive_json() == {"error": "upload larger than announced"}
+        ws.send_json({"op": "size"})
+        assert ws.receive_json()["size"] == 8
+
+    from obsync.db import vaultfiles
+    from obsync.db.exceptions import StorageLimitExceeded
+
+    staged = blobstore.stage(b"123")
+    with pytest.raises(StorageLimitExceeded):
+        asyncio.run(vaultfiles.insert_metadata(vaultfiles.File(vault_id=vault_id, path="c.md", size=1), staged, 10))
+    assert not os.path.exists(staged.path)
+
+
+def test_identical_content_is_stored_once():
+    data = os.urandom(2048)
+    uids = []
+    for _ in range(2):
+        vault_id = _new_vault()
+        with client.websocket_connect("/ws.obsidian.md") as ws:
+            _connect(ws, vault_id)
+            uids.append(_push(ws, "same.md", data))
+            uids.append(_push(ws, "copy.md", data))
+
+    from obsync.db.db import SessionFactory
+    from obsync.db.models import Blob, File
+
+    with SessionFactory() as session:
+        keys = {row.blob for row in session.query(File.blob).filter(File.uid.in_(uids))}
+        assert len(keys) == 1
+        blob = session.query(Blob).filter(Blob.hash == keys.pop()).one()
+        assert blob.refcount == 4
+        assert blobstore.read(blob.hash) == data
+
+
+def test_delta_push_is_rebuilt_and_stored_as_delta():
+    from obsync.db.db import SessionFactory
+    from obsync.db.models import Blob, File
+    from obsync.storage import delta
+
+    base = os.urandom(8192)
+    edited = base[:4000] + b"an edit in the middle" + base[4000:]
+    patch = delta.diff(base, edited)
+    assert len(patch) < 200
+
+    vault_id = _new_vault()
+    with client.websocket_connect("/ws.obsidian.md") as ws:
+        _connect(ws, vault_id)
+        _push(ws, "note.md", base, hash="base-hash")
+        ws.send_json({
+            "op": "push", "path": "note.md", "hash": "edited-hash", "size": len(edited),
+            "pieces": 1, "delta_base": "base-hash",
+        })
+        assert ws.receive_json() == {"res": "next"}
+        ws.send_bytes(patch)
+        broadcast = ws.receive_json()
+        assert "delta_base" not in broadcast
+        assert ws.receive_json() == {"op": "ok"}
+        assert _pull(ws, broadcast["uid"]) == edited
+
+        ws.send_json({
+            "op": "push", "path": "note.md", "size": len(edited), "pieces": 1, "delta_base": "nope",
+        })
+        assert ws.receive_json() == {"res": "next"}
+        ws.send_bytes(patch)
+        assert ws.receive_json() == {"error": "unknown delta base"}
+
+    with SessionFactory() as session:
+        key = session.query(File.blob).filter(File.uid == broadcast["uid"]).scalar()
+        blob = session.query(Blob).filter(Blob.hash == key).one()
+        assert blob.base is not None and blob.depth == 1
+        assert os.path.exists(blobstore.delta_path(key))
+
+
+def test_disconnect_mid_push_leaves_no_temp_files(monkeypatch):
+    import time
+    from obsync.db import vaultfiles
+
+    async def never(*args):
+        await asyncio.Event().wait()
+
+    monkeypatch.setattr(vaultfiles, "get_revision_blob", never)
+    before = set(os.listdir(blobstore.TmpDir)) if os.path.isdir(blobstore.TmpDir) else set()
+    vault_id = _new_vault()
+    with client.websocket_connect("/ws.obsidian.md") as ws:
+        _connect(ws, vault_id)
+        ws.send_json({"op": "push", "path": "note.md", "size": 10, "pieces": 1, "delta_base": "base"})
+        assert ws.receive_json() == {"res": "next"}
+        ws.send_bytes(b"patch")
+        # Staged and now stuck looking up the base, until the disconnect cancels it
+        deadline = time.monotonic() + 5
+        while set(os.listdir(blobstore.TmpDir)) == before and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert set(os.listdir(blobstore.TmpDir)) != before
+
+    deadline = time.monotonic() + 5
+    while set(os.listdir(blobstore.TmpDir)) != before and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert set(os.listdir(blobstore.TmpDir)) == before
+
+
+def test_stale_temp_files_are_swept():
+    import time
+
+    stale, fresh = blobstore.BlobWriter().finish(), blobstore.BlobWriter().finish()
+    old = time.time() - blobstore.STALE_TMP_S - 60
+    os.utime(stale.path, (old, old))
+    assert blobstore.sweep_tmp() >= 1
+    assert not os.path.exists(stale.path) and os.path.exists(fresh.path)
+    blobstore.discard(fresh)
+
+
+def test_text_is_compressed_and_encrypted_content_is_not(monkeypatch):
+    from obsync.db.db import SessionFactory
+    from obsync.db.models import Blob, File
+    from obsync.storage import codecs
+
+    monkeypatch.setattr(config, "Compression", codecs.ZLIB)
+    note = b"# Heading\n" + b"Some very repetitive markdown text.\n" * 500
+    encrypted = os.urandom(len(note))
+
+    vault_id = _new_vault()
+    with client.websocket_connect("/ws.obsidian.md") as ws:
+        _connect(ws, vault_id)
+        note_uid = _push(ws, "note.md", note, pieces=2)
+        encrypted_uid = _push(ws, "secret.md", encrypted)
+        assert _pull(ws, note_uid) == note
+        assert _pull(ws, encrypted_uid) == encrypted
+
+    with SessionFactory() as session:
+        codec = dict(
+            session.query(File.uid, Blob.codec)
+            .join(Blob, Blob.hash == File.blob)
+            .filter(File.uid.in_([note_uid, encrypted_uid]))
+            .all()
+        )
+    assert codec == {note_uid: codecs.ZLIB, encrypted_uid: codecs.NONE}
+
+
+def test_recompression_job_compresses_existing_blobs(monkeypatch):
+    from obsync.db.db import SessionFactory
+    from obsync.db.models import Blob, File
+    from obsync.storage import codecs
+    from obsync.tasks import recompression
+
+    note = b"an old note written before compression was enabled\n" * 200
+    monkeypatch.setattr(config, "Compression", codecs.NONE)
+    vault_id = _new_vault()
+    with client.websocket_connect("/ws.obsidian.md") as ws:
+        _connect(ws, vault_id)
+        uid = _push(ws, "old.md", note)
+
+    with SessionFactory() as session:
+        key = session.query(File.blob).filter(File.uid == uid).scalar()
+        session.query(Blob).filter(Blob.hash == key).update({Blob.codec: None})
+        session.commit()
+
+    monkeypatch.setattr(config, "Compression", codecs.ZLIB)
+    while asyncio.run(recompression.recompress_blobs()):
+        pass
+
+    with SessionFactory() as session:
+        assert session.query(Blob.codec).filter(Blob.hash == key).scalar() == codecs.ZLIB
+    assert not os.path.exists(blobstore.blob_path(key))
+    assert os.path.exists(blobstore.compressed_path(key, codecs.ZLIB))
+    with client.websocket_connect("/ws.obsidian.md") as ws:
+        _connect(ws, vault_id)
+        assert _pull(ws, uid) == note
+
+
+def test_tagged_pushes_are_pipelined():
+    vault_id = _new_vault()
+    files = {f"batch/{i}.md": os.urandom(100 + i) for i in range(10)}
+    with client.websocket_connect("/ws.obsidian.md") as ws:
+        _connect(ws, vault_id)
+        # Every push and its piece go out without waiting for a single reply
+        for tag, (path, data) in enumerate(files.items()):
+            ws.send_json({
+                "op": "push", "path": path, "hash": path, "size": len(data), "pieces": 1, "tag": tag,
+            })
+            ws.send_bytes(data)
+        ws.send_json({"op": "ping", "tag": "ping"})
+
+        acked, uids, pong = set(), {}, False
+        while len(acked) < len(files) or len(uids) < len(files) or not pong:
+            msg = ws.receive_json()
+            if msg.get("op") == "ok":
+                acked.add(msg["tag"])
+            elif msg.get("op") == "pong":
+                pong = msg["tag"] == "ping"
+            else:
+                assert "tag" not in msg  # NOTE: broadcasts are not replies
+                uids[msg["path"]] = msg["uid"]
+        assert acked == set(range(len(files)))
+
+        ws.send_json({"op": "pull", "uid": uids["batch/3.md"], "tag": "pull"})
+        header = ws.receive_json()
+        assert header["tag"] == "pull" and header["pieces"] == 1
+        assert ws.receive_bytes() == files["batch/3.md"]
+
+
+def test_tagged_pushes_to_one_path_keep_their_order():
+    vault_id = _new_vault()
+    with client.websocket_connect("/ws.obsidian.md") as ws:
+        _connect(ws, vault_id)
+        for i in range(5):
+            data = f"revision {i}".encode()
+            ws.send_json({
+                "op": "push", "path": "same.md", "hash": str(i), "size": len(data), "pieces": 1, "tag": i,
+            })
+            ws.send_bytes(data)
+        broadcasts = []
+        while len(broadcasts) < 5:
+            msg = ws.receive_json()
+            if msg.get("op") == "push":
+                broadcasts.append(msg["hash"])
+        assert broadcasts == ["0", "1", "2", "3", "4"]
+
+    with client.websocket_connect("/ws.obsidian.md") as ws:
+        _, pushes = _connect(ws, vault_id)
+        assert [p["hash"] for p in pushes] == ["4"]
+
+
+def test_pieces_of_refused_tagged_push_are_dropped(monkeypatch):
+    vault_id = _new_vault()
+    monkeypatch.setattr(config, "MaxStorageBytes", 100)
+    with client.websocket_connect("/ws.obsidian.md") as ws:
+        _connect(ws, vault_id)
+        # More pieces than are buffered for a push, all owed to a push that is refused
+        ws.send_json({"op": "push", "path": "big.md", "hash": "big", "size": 1000, "pieces": 10, "tag": "big"})
+        for _ in range(10):
+            ws.send_bytes(b"x" * 100)
+        ws.send_json({"op": "push", "path": "small.md", "hash": "small", "size": 5, "pieces": 1, "tag": "small"})
+        ws.send_bytes(b"small")
+
+        replies = {}
+        while len(replies) < 2:
+            msg = ws.receive_json()
+            if "tag" in msg:
+                replies[msg["tag"]] = msg
+            else:
+                uid = msg["uid"]
+        assert "error" in replies["big"] and replies["small"] == {"op": "ok", "tag": "small"}
+        assert _pull(ws, uid) == b"small"
+
+        # A push without pieces leaves nothing behind to take the next push's piece
+        ws.send_json({"op": "push", "path": "empty.md", "size": 3, "pieces": 0})
+        assert ws.receive_json()["path"] == "empty.md"
+        assert ws.receive_json() == {"op": "ok"}
+        assert _pull(ws, _push(ws, "after.md", b"after")) == b"after"
+
+
+def test_history_is_paged_with_last_cursor(monkeypatch):
+    monkeypatch.setattr(config, "HistoryPageSize", 2)
+    vault_id = _new_vault()
+    with client.websocket_connect("/ws.obsidian.md") as ws:
+        _connect(ws, vault_id)
+        uids = [_push(ws, "autosave.md", f"rev {i}".encode(), mtime=1000 + i) for i in range(5)]
+
+        pages, last = [], None
+        while True:
+            ws.send_json({"op": "history", "path": "autosave.md", "last": last})
+            page = ws.receive_json()
+            pages.append([item["uid"] for item in page["items"]])
+            if not page["more"]:
+                break
+            last = page["items"][-1]["uid"]
+        assert pages == [uids[:2:-1], uids[2:0:-1], uids[:1]]
+
+        # A cursor that is not a revision of this path ends the listing instead of restarting it
+        other_uid = _push(ws, "other.md", b"other")
+        for cursor in (other_uid, uids[-1] + 1000):
+            ws.send_json({"op": "history", "path": "autosave.md", "last": cursor})
+            assert ws.receive_json() == {"items": [], "more": False}
+
+    other = _new_vault()
+    with client.websocket_connect("/ws.obsidian.md") as ws:
+        _connect(ws, other)
+        ws.send_json({"op": "history", "path": "autosave.md"})
+        assert ws.receive_json() == {"items": [], "more": False}
+
+
+def test_deleted_listing_is_scoped_and_paged(monkeypatch):
+    from obsync.routes import ws as ws_routes
+
+    monkeypatch.setattr(ws_routes, "LISTING_BATCH_SIZE", 2)
+    vault_id = _new_vault()
+    paths = [f"trash/{i}.md" for i in range(5)]
+    with client.websocket_connect("/ws.obsidian.md") as ws:
+        _connect(ws, vault_id)
+        for path in paths + ["kept.md"]:
+            _push(ws, path, b"x")
+        for path in paths:
+            ws.send_json({"op": "push", "path": path, "deleted": True, "size": 0})
+            ws.receive_json()
+            assert ws.receive_json() == {"op": "ok"}
+
+        ws.send_json({"op": "deleted"})
+        assert [item["path"] for item in ws.receive_json()["items"]] == paths
+
+        ws.send_json({"op": "deleted", "tag": 1})
+        pages = [ws.receive_json() for _ in range(3)]
+        assert [len(p["items"]) for p in pages] == [2, 2, 1]
+        assert [p["more"] for p in pages] == [True, True, False]
+
+    with client.websocket_connect("/ws.obsidian.md") as ws:
+        _connect(ws, _new_vault())
+        ws.send_json({"op": "deleted"})
+        assert ws.receive_json() == {"items": []}
+
+
+def test_vault_cache_never_keeps_a_stale_version(monkeypatch):
+    from obsync.db import vault
+    from obsync.db.db import SessionFactory
+    from obsync.db.models import Share, Vault
+
+    cache = vault.VaultCache()
+    generation = cache.generation()
+    cache.set_version("vault", 5)
+    cache.put("vault", object(), generation)
+    assert cache.get("vault") is None
+
+    vault_id = _new_vault()
+    assert asyncio.run(vault.get_vault(vault_id, keyhash)).version == 0
+    with SessionFactory() as session:
+        # Written by another worker, behind this process's back
+        session.query(Vault).filter(Vault.id == vault_id).update({Vault.version: 7})
+        session.add(Share(uid=uuid.uuid4().hex, email="friend@example.com", name="friend", vault_id=vault_id))
+        session.commit()
+    assert asyncio.run(vault.get_vault(vault_id, keyhash)).version == 0
+
+    monkeypatch.setattr(config, "BroadcastBackend", "sqlite")
+    assert asyncio.run(vault.get_vault(vault_id, keyhash)).version == 7
+    assert asyncio.run(vault.has_access_to_vault(vault_id, "friend@example.com"))
+    assert asyncio.run(vault.has_access_to_vault(vault_id, email))
+    assert not asyncio.run(vault.has_access_to_vault(vault_id, "stranger@example.com"))
@@ -0,0 +1,73 @@
+import asyncio
+
+from obsync.pubsub import SQLiteBackend
+from obsync.routes import ws as ws_routes
+from obsync.routes.ws import ChannelManager, Client
+
+
+class StalledSocket:
+    """A websocket whose peer never reads."""
+
+    def __init__(self):
+        self.sent = []
+        self.closed_with = None
+
+    async def send_text(self, data):
+        self.sent.append(data)
+        await asyncio.Event().wait()
+
+    async def close(self, code=1000):
+        self.closed_with = code
+
+
+class FastSocket(StalledSocket):
+    async def send_text(self, data):
+        self.sent.append(data)
+
+
+def test_broadcast_drops_client_that_falls_behind(monkeypatch):
+    monkeypatch.setattr(ws_routes, "SEND_QUEUE_SIZE", 4)
+
+    async def scenario():
+        slow, fast = StalledSocket(), FastSocket()
+        slow_client, fast_client = Client(slow), Client(fast)
+        channel = ChannelManager("vault", clients={})
+        channel.add_client(slow_client)
+        channel.add_client(fast_client)
+
+        for i in range(10):
+            channel.deliver(f'{{"op": "push", "i": {i}}}')
+            await asyncio.sleep(0)
+
+        await fast_client.close()
+        await asyncio.sleep(0)
+        return channel, slow, fast
+
+    channel, slow, fast = asyncio.run(scenario())
+    assert len(fast.sent) == 10
+    assert slow.closed_with == 1013
+    assert len(channel.clients) == 1
+
+
+def test_sqlite_backend_reaches_other_processes(tmp_path):
+    path = str(tmp_path / "broadcast.db")
+
+    async def scenario():
+        received = {"a": [], "b": []}
+        a = SQLiteBackend(path, poll_interval=0.01)
+        b = SQLiteBackend(path, poll_interval=0.01)
+        await a.start(lambda channel, message: received["a"].append((channel, message)))
+        await b.start(lambda channel, message: received["b"].append((channel, message)))
+
+        await a.publish("vault", "hello")
+        for _ in range(100):
+            if received["b"]:
+                break
+            await asyncio.sleep(0.01)
+        await a.stop()
+        await b.stop()
+        return received
+
+    received = asyncio.run(scenario())
+    assert received["a"] == [("vault", "hello")]
+    assert received["b"] == [("vault", "hello")]